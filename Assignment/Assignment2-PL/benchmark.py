@@ -0,0 +1,260 @@
+# Benchmark suite for the expression evaluator in main.py
+# Generates synthetic corpora and times tokenizer, parser, calculator and
+# run_from_file separately
+# usage: python benchmark.py --expressions 20000 --depth 4 --save results.json
+#        python benchmark.py --compare results.json
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import main
+
+# Corpus generator
+
+# default operator mix (relative weights), '^' is generated as literal ^ small
+# exponent so results stay printable
+OPERATOR_MIX = {'+': 4, '-': 4, '*': 3, '/': 2, '^': 1}
+
+# --mix value: 'op=weight,...' with known operators and non-negative weights
+# generate_expression joins operands with the binary operators, so one of them needs a weight
+def parse_mix(text):
+    mix = {}
+    for item in text.split(','):
+        op, _, weight = item.partition('=')
+        op = op.strip()
+        if op not in OPERATOR_MIX:
+            raise argparse.ArgumentTypeError(f"unknown operator in {item!r}")
+        try:
+            mix[op] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"bad weight in {item!r}")
+        if not mix[op] >= 0 or mix[op] == float('inf'):
+            raise argparse.ArgumentTypeError(f"bad weight in {item!r}")
+    if not any(weight > 0 for op, weight in mix.items() if op != '^'):
+        raise argparse.ArgumentTypeError("needs a positive weight for one of + - * /")
+    return mix
+
+# kinds of errors injected into a corpus
+ERROR_KINDS = ['operator', 'parenthesis', 'character', 'zero']
+
+# a random literal with 1..literal_length digits
+def generate_literal(rng, literal_length):
+    length = rng.randint(1, literal_length)
+    # no leading zeros except for 0 itself
+    return str(rng.randint(10 ** (length - 1) if length > 1 else 0, 10 ** length - 1))
+
+# one operand: nested subexpression, power or literal
+def generate_operand(rng, depth, width, mix, literal_length):
+    if depth > 0 and rng.random() < 0.5:
+        operand = '(' + generate_expression(rng, depth - 1, width, mix, literal_length) + ')'
+    elif '^' in mix and rng.random() < mix['^'] / sum(mix.values()):
+        operand = f"{generate_literal(rng, literal_length)} ^ {rng.randint(0, 3)}"
+    else:
+        operand = generate_literal(rng, literal_length)
+    # occasional unary minus
+    if rng.random() < 0.1:
+        operand = '-' + operand
+    return operand
+
+# width operands joined by binary operators, nested up to depth levels
+def generate_expression(rng, depth, width, mix, literal_length):
+    operators = [op for op in mix if op != '^']
+    weights = [mix[op] for op in operators]
+    parts = [generate_operand(rng, depth, width, mix, literal_length)]
+    for _ in range(width - 1):
+        parts.append(rng.choices(operators, weights)[0])
+        parts.append(generate_operand(rng, depth, width, mix, literal_length))
+    return ' '.join(parts)
+
+# turn a valid expression into an invalid one (or one that divides by zero)
+def inject_error(rng, expr):
+    kind = rng.choice(ERROR_KINDS)
+    if kind == 'operator':
+        return expr + ' * + 1'
+    if kind == 'parenthesis':
+        return '(' + expr
+    if kind == 'character':
+        return expr + ' + 3a'
+    return expr + ' / 0'
+
+# list of expressions
+# error_rate: fraction of expressions with an injected error
+def generate_corpus(count, depth=3, width=3, mix=None, literal_length=3, error_rate=0.1, seed=0):
+    rng = random.Random(seed)
+    mix = mix or OPERATOR_MIX
+    corpus = []
+    for _ in range(count):
+        expr = generate_expression(rng, depth, width, mix, literal_length)
+        if rng.random() < error_rate:
+            expr = inject_error(rng, expr)
+        corpus.append(expr)
+    return corpus
+
+# Timing
+
+# best time of repeat runs of fn()
+def best_time(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+# peak traced memory (bytes) of one run of fn()
+# measured in a separate pass because tracemalloc slows everything down
+def peak_memory(fn):
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+# parse every token list, invalid expressions are skipped
+def parse_all(token_lists):
+    trees = []
+    for tokens in token_lists:
+        try:
+            trees.append(main.parser(tokens))
+        except ValueError:
+            pass
+    return trees
+
+# evaluate every parse tree, division by zero is skipped
+def calculate_all(trees):
+    for tree in trees:
+        try:
+            main.calculator(tree)
+        except ZeroDivisionError:
+            pass
+
+# time every stage on one corpus
+def run_benchmark(corpus, repeat=3, memory=True):
+    # inputs of each stage are prepared ahead, so every stage is timed alone
+    token_lists = [main.tokenizer(expr) for expr in corpus]
+    trees = parse_all(token_lists)
+    tokens = sum(len(tokens) for tokens in token_lists)
+    nodes = sum(main.count_nodes(tree) for tree in trees)
+
+    stages = {
+        "tokenizer": (lambda: [main.tokenizer(expr) for expr in corpus], "tokens", tokens),
+        "parser": (lambda: parse_all(token_lists), "nodes", nodes),
+        "calculator": (lambda: calculate_all(trees), "nodes", nodes),
+    }
+
+    results = {}
+    for name, (fn, unit, amount) in stages.items():
+        seconds = best_time(fn, repeat)
+        results[name] = {
+            "seconds": seconds,
+            f"{unit}_per_sec": amount / seconds if seconds else 0.0,
+        }
+        if memory:
+            results[name]["peak_bytes"] = peak_memory(fn)
+
+    # run_from_file on the corpus written to a temporary file
+    with tempfile.TemporaryDirectory() as directory:
+        input_file = os.path.join(directory, 'expressions.txt')
+        result_file = os.path.join(directory, 'result.txt')
+        with open(input_file, 'w') as write:
+            write.write('\n'.join(corpus) + '\n')
+
+        stats = None
+        seconds = None
+        for _ in range(repeat):
+            run = main.run_from_file(input_file, result_file)
+            if seconds is None or run["seconds"] < seconds:
+                stats, seconds = run, run["seconds"]
+        results["run_from_file"] = {
+            "seconds": seconds,
+            "expressions_per_sec": stats["expressions_per_sec"],
+            "bytes_per_sec": stats["bytes_per_sec"],
+        }
+        if memory:
+            results["run_from_file"]["peak_bytes"] = peak_memory(lambda: main.run_from_file(input_file, result_file))
+
+    return {"expressions": len(corpus), "valid": len(trees), "tokens": tokens, "nodes": nodes, "stages": results}
+
+# Reporting
+
+def print_results(report):
+    print(f"{report['expressions']} expressions ({report['valid']} valid), "
+          f"{report['tokens']} tokens, {report['nodes']} nodes")
+    for name, stage in report["stages"].items():
+        rates = ', '.join(f"{value:,.0f} {key.replace('_per_sec', '')}/sec"
+                          for key, value in stage.items() if key.endswith('_per_sec'))
+        memory = f", peak {stage['peak_bytes'] / 1024:,.0f} KiB" if 'peak_bytes' in stage else ''
+        print(f"  {name:<14} {stage['seconds']:.4f}s  {rates}{memory}")
+
+# compare against a saved run, returns the names of regressed stages
+# threshold: allowed slowdown (0.1 = 10%)
+def compare_results(report, baseline, threshold=0.1):
+    regressions = []
+    print(f"Compared with {baseline['timestamp']}:")
+    # times are only comparable on the same corpus
+    if baseline.get("config") != report.get("config"):
+        print("  warning: the saved run used a different corpus configuration")
+    for name, stage in report["stages"].items():
+        if name not in baseline["stages"]:
+            continue
+        old = baseline["stages"][name]["seconds"]
+        change = (stage["seconds"] - old) / old if old else 0.0
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f"  {name:<14} {old:.4f}s -> {stage['seconds']:.4f}s ({change:+.1%}){flag}")
+    return regressions
+
+# run the benchmark
+if __name__ == '__main__':
+    arguments = argparse.ArgumentParser(description="Benchmark the expression evaluator")
+    arguments.add_argument('--expressions', type=int, default=10000, help="corpus size")
+    arguments.add_argument('--depth', type=int, default=3, help="maximum parenthesis nesting")
+    arguments.add_argument('--width', type=int, default=3, help="operands per (sub)expression")
+    arguments.add_argument('--mix', type=parse_mix, default=None, help="operator weights, e.g. '+=4,-=4,*=3,/=2,^=1'")
+    arguments.add_argument('--literal-length', type=int, default=3, help="maximum digits per literal")
+    arguments.add_argument('--error-rate', type=float, default=0.1, help="fraction of invalid expressions")
+    arguments.add_argument('--seed', type=int, default=0, help="random seed of the corpus")
+    arguments.add_argument('--repeat', type=int, default=3, help="runs per stage, the best is kept")
+    arguments.add_argument('--no-memory', action='store_true', help="skip the peak memory pass")
+    arguments.add_argument('--save', default=None, help="save results to a JSON file")
+    arguments.add_argument('--compare', default=None, help="compare with results saved by --save")
+    arguments.add_argument('--threshold', type=float, default=0.1, help="slowdown reported as a regression")
+    args = arguments.parse_args()
+
+    # operator mix from the command line
+    mix = args.mix
+
+    config = {
+        "expressions": args.expressions, "depth": args.depth, "width": args.width,
+        "mix": mix or OPERATOR_MIX, "literal_length": args.literal_length,
+        "error_rate": args.error_rate, "seed": args.seed, "repeat": args.repeat,
+    }
+    corpus = generate_corpus(args.expressions, args.depth, args.width, mix,
+                             args.literal_length, args.error_rate, args.seed)
+    report = run_benchmark(corpus, args.repeat, memory=not args.no_memory)
+    report["config"] = config
+    report["timestamp"] = datetime.datetime.now().isoformat()
+    report["python"] = platform.python_version()
+    print_results(report)
+
+    regressions = []
+    if args.compare:
+        with open(args.compare, 'r') as read:
+            regressions = compare_results(report, json.load(read), args.threshold)
+    if args.save:
+        with open(args.save, 'w') as write:
+            json.dump(report, write, indent=4)
+    # non-zero exit status when a stage regressed
+    sys.exit(1 if regressions else 0)
@@ -2,50 +2,118 @@
 # Building a Parse Tree Based Arithmetic Expression Evaluator
 # Build tokenizer, parsing & validation, and calculate
 
+import argparse
+import array
+import collections
+import concurrent.futures
+import functools
+import io
+import math
+import operator
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+# NumPy is only needed for vectorized evaluation (vector_calculator)
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # Tokenizer
+# single-pass regex scanner
+# one alternative per token kind, so the kind is the index of the group that matched
+# numbers are ASCII digit runs, whitespace (space, tab, newline) is skipped
+# and any other character becomes an invalid single character token
+# with variables, identifiers (a, rate, x_1) are single NAME tokens
+NUMBER, OPERATOR, OPEN, CLOSE, INVALID, NAME = 1, 2, 3, 4, 5, 6
+SCANNER = re.compile(r'([0-9]+)|([-+*/^])|(\()|(\))|([^ \t\n])')
+VARIABLE_SCANNER = re.compile(r'([0-9]+)|([-+*/^])|(\()|(\))|((?![A-Za-z_])[^ \t\n])|([A-Za-z_][A-Za-z0-9_]*)')
+# same tokens without the kinds, used by the list-of-strings tokenizer
+TOKEN_TEXT = re.compile(r'[0-9]+|[^ \t\n]')
+VARIABLE_TOKEN_TEXT = re.compile(r'[0-9]+|[A-Za-z_][A-Za-z0-9_]*|[^ \t\n]')
+IDENTIFIER = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+
+# typed token with its offsets in the source string
+Token = collections.namedtuple('Token', ['kind', 'text', 'start', 'end'])
+
+# compact token storage
+# kinds and offsets live in arrays, the text is sliced from the source on access
+# indexing and iterating give the token strings, so it can be passed to parser
+class TokenArray:
+    def __init__(self, source):
+        self.source = source
+        self.kinds = array.array('B')
+        self.starts = array.array('q')
+        self.ends = array.array('q')
+
+    def append(self, kind, start, end):
+        self.kinds.append(kind)
+        self.starts.append(start)
+        self.ends.append(end)
+
+    def __len__(self):
+        return len(self.kinds)
+
+    # token string at index
+    def __getitem__(self, index):
+        return self.source[self.starts[index]:self.ends[index]]
+
+    def __iter__(self):
+        source = self.source
+        for start, end in zip(self.starts, self.ends):
+            yield source[start:end]
+
+    # typed token at index
+    def token(self, index):
+        return Token(self.kinds[index], self[index], self.starts[index], self.ends[index])
+
+    # list-of-strings view (same as tokenizer)
+    def strings(self):
+        return list(self)
+
+# scan the expression into typed tokens
+# compact=True stores them in a TokenArray instead of a list of Token
+# variables=True scans identifiers as NAME tokens
+def scan(expr, compact=False, variables=False):
+    scanner = VARIABLE_SCANNER if variables else SCANNER
+    if compact:
+        tokens = TokenArray(expr)
+        # bind the array appends once, this loop runs per token
+        add_kind, add_start, add_end = tokens.kinds.append, tokens.starts.append, tokens.ends.append
+        for match in scanner.finditer(expr):
+            add_kind(match.lastindex)
+            start, end = match.span()
+            add_start(start)
+            add_end(end)
+        return tokens
+    return [Token(match.lastindex, match.group(), match.start(), match.end())
+            for match in scanner.finditer(expr)]
+
 # Tokenizes the input expression string into a list of tokens
-def tokenizer(expr):
-    # tokens: a list of tokens from the input expression string
-    tokens = []
-    # number: to build multi-digit numbers
-    number = ''
-    
-    # iterate through each character in the expression
-    for char in expr:
-        # if the character is a digit, build the number
-        if char in '0123456789':
-            number += char
-        # not digit
-        else:
-            # append integer value of number to token
-            if number:
-                tokens.append(number)
-                number = ''
-            
-            # append operators and parentheses to token
-            if char in '^+-*/()':
-                tokens.append(char)
-            # ignore whitespace
-            elif char in ' \t\n':
-                continue
-            #invalid character
-            else:
-                tokens.append(char)
-                
-    # if number still not empty, add it to token
-    if number:
-            tokens.append(number)
-            number = ''
-    
-    # return the token list
-    return tokens   
+# list-of-strings view of the scanner
+# variables=True keeps identifiers together as one token
+def tokenizer(expr, variables=False):
+    if variables:
+        return VARIABLE_TOKEN_TEXT.findall(expr)
+    return TOKEN_TEXT.findall(expr)
+
+# check if a token is a variable name
+def is_variable(token):
+    return IDENTIFIER.fullmatch(token) is not None
 
 # Parsing
 # Recursive descent parser based on operator precedence
 
-# parse factor: highest precedence: (), numbers, unary -
-# factor -> - factor | ( expr ) | integer
-def parse_factor(tokens, index):
+# variables: accept identifiers as ('var', name) leaves, off by default so
+# result.txt keeps rejecting them
+
+# parse factor: highest precedence: (), numbers, variables, unary -
+# factor -> - factor | ( expr ) | integer | variable
+def parse_factor(tokens, index, variables=False):
     # check if index is within bounds
     if index >= len(tokens):
         raise ValueError("Unexpected end of expression")
@@ -57,7 +125,7 @@ def parse_factor(tokens, index):
     if token == '-':
         # right associative
         # recursively parse the next factor
-        subtree, next = parse_factor(tokens, index + 1)
+        subtree, next = parse_factor(tokens, index + 1, variables)
 
         # add unary minus node to the parse tree and return
         return ('neg', subtree), next
@@ -65,10 +133,13 @@ def parse_factor(tokens, index):
     elif token.isdigit():
         # return the number as an integer
         return int(token), index + 1
+    # handle variables
+    elif variables and is_variable(token):
+        return ('var', token), index + 1
     # handle parentheses
     elif token == '(':
         # recursively call expr to parse the expression inside parentheses
-        subtree, next = parse_expr(tokens, index + 1)
+        subtree, next = parse_expr(tokens, index + 1, variables)
         # check for closing parenthesis
         # check for length as well to avoid index error
         if next >= len(tokens) or tokens[next] != ')':
@@ -83,16 +154,16 @@ def parse_factor(tokens, index):
 # parse power: 2nd highest precedence: ^
 # right associative
 # power -> <factor> ( ^ <power> )
-def parse_power(tokens, index):
+def parse_power(tokens, index, variables=False):
     # parse the left factor
-    left, next = parse_factor(tokens, index)
+    left, next = parse_factor(tokens, index, variables)
 
     # if the next token is ^, parse the right power
     if next < len(tokens) and tokens[next] == '^':
         # get the operator
         op = tokens[next]
         # parse the right power (right associative)
-        right, next = parse_power(tokens, next + 1)
+        right, next = parse_power(tokens, next + 1, variables)
         # build the subtree
         left = (op, left, right)
     
@@ -102,16 +173,16 @@ def parse_power(tokens, index):
 # parse term: 3rd highest precedence: *, /
 # left associative
 # term -> power ( (*|/) power )
-def parse_term(tokens, index):
+def parse_term(tokens, index, variables=False):
     # parse the left power
-    left, next = parse_power(tokens, index)
+    left, next = parse_power(tokens, index, variables)
 
     # while the next token is */, parse the right power
     while next < len(tokens) and tokens[next] in '*/':
         # get the operator
         op = tokens[next]
         # parse the right power
-        right, next = parse_power(tokens, next + 1)
+        right, next = parse_power(tokens, next + 1, variables)
         # build the subtree
         left = (op, left, right)
     
@@ -121,16 +192,16 @@ def parse_term(tokens, index):
 # parse expr: lowest precedence: +, -
 # left associative
 # expr -> term ( (+|-) term )
-def parse_expr(tokens, index):
+def parse_expr(tokens, index, variables=False):
     # parse the left term
-    left, next = parse_term(tokens, index)
+    left, next = parse_term(tokens, index, variables)
 
     # while the next token is +-, parse the right term
     while next < len(tokens) and tokens[next] in '+-':
         # get the operator
         op = tokens[next]
         # parse the right term
-        right, next = parse_term(tokens, next + 1)
+        right, next = parse_term(tokens, next + 1, variables)
         # build the subtree
         left = (op, left, right)
     
@@ -139,16 +210,107 @@ def parse_expr(tokens, index):
 
 # Parser
 # Parses and detects invalid expressions
-def parser(tokens):
+def parser(tokens, variables=False):
     # parse tree: tuple (operator, left subtree, right subtree)
     parse_tree = ()
-    parse_tree, num_of_tokens = parse_expr(tokens, 0)
+    parse_tree, num_of_tokens = parse_expr(tokens, 0, variables)
     if num_of_tokens != len(tokens):
         raise ValueError("Invalid expression")
     return parse_tree
 
+# Iterative parser
+# explicit-stack (shunting-yard) version of parse_expr that builds the same trees
+# used for machine generated input that is nested too deeply for recursion
+
+# binary operator precedence and associativity
+# unary minus binds tighter than every binary operator (factor -> - factor)
+PRECEDENCE = {'+': 1, '-': 1, '*': 2, '/': 2, '^': 3, 'neg': 4}
+RIGHT_ASSOCIATIVE = {'^'}
+
+# pop the top operator and combine it with its operands
+def reduce_operator(operators, operands):
+    op = operators.pop()
+    # unary minus takes a single operand
+    if op == 'neg':
+        operands.append(('neg', operands.pop()))
+    else:
+        right = operands.pop()
+        left = operands.pop()
+        operands.append((op, left, right))
+
+def iterative_parser(tokens, variables=False):
+    # operators: pending operators and open parentheses
+    operators = []
+    # operands: finished subtrees
+    operands = []
+    # expect_operand: True when a factor must come next
+    expect_operand = True
+
+    for token in tokens:
+        if expect_operand:
+            # handle unary minus
+            if token == '-':
+                operators.append('neg')
+            # handle parentheses
+            elif token == '(':
+                operators.append(token)
+            # handle numbers
+            elif token.isdigit():
+                operands.append(int(token))
+                expect_operand = False
+            # handle variables
+            elif variables and is_variable(token):
+                operands.append(('var', token))
+                expect_operand = False
+            # unexpected token
+            else:
+                raise ValueError(f"Unexpected token: {token}")
+        # binary operators
+        elif token in PRECEDENCE and token != 'neg':
+            precedence = PRECEDENCE[token]
+            # reduce operators that bind at least as tightly (left associative)
+            # or strictly tighter (right associative)
+            while operators and operators[-1] != '(':
+                top = PRECEDENCE[operators[-1]]
+                if top > precedence or (top == precedence and token not in RIGHT_ASSOCIATIVE):
+                    reduce_operator(operators, operands)
+                else:
+                    break
+            operators.append(token)
+            expect_operand = True
+        # closing parenthesis
+        elif token == ')':
+            while operators and operators[-1] != '(':
+                reduce_operator(operators, operands)
+            # no matching open parenthesis
+            if not operators:
+                raise ValueError("Invalid expression")
+            operators.pop()
+        # anything else after a complete factor
+        else:
+            raise ValueError("Invalid expression")
+
+    # the expression cannot end on an operator
+    if expect_operand:
+        raise ValueError("Unexpected end of expression")
+
+    # reduce the remaining operators
+    while operators:
+        if operators[-1] == '(':
+            raise ValueError("Mismatched parentheses")
+        reduce_operator(operators, operands)
+
+    return operands[0]
+
+# value of a variable in the bindings dictionary
+def lookup_variable(name, bindings):
+    if bindings is None or name not in bindings:
+        raise NameError(f"Unbound variable: {name}")
+    return bindings[name]
+
 # calculate
-def calculator(parse_tree):
+# bindings: values of the variables, {name: value}
+def calculator(parse_tree, bindings=None):
     # if the parse tree is an integer, return it
     if isinstance(parse_tree, int):
         return parse_tree
@@ -156,13 +318,17 @@ def calculator(parse_tree):
     # get the operator
     op = parse_tree[0]
 
+    # handle variables
+    if op == 'var':
+        return lookup_variable(parse_tree[1], bindings)
+
     # handle unary minus
     if op == 'neg':
-        return -calculator(parse_tree[1])
+        return -calculator(parse_tree[1], bindings)
     
     # recursively evaluate left and right subtrees
-    left = calculator(parse_tree[1])
-    right = calculator(parse_tree[2])
+    left = calculator(parse_tree[1], bindings)
+    right = calculator(parse_tree[2], bindings)
 
     # perform the operation based on the operator
     if op == '+':
@@ -178,42 +344,842 @@ def calculator(parse_tree):
     elif op == '^':
         return left ** right
 
-# access and run files
-def run_from_file(input_file, result_file):
-    # read expressions from input file
-    with open(input_file, 'r') as read:
-        expressions = read.readlines()
-    
-    # write results to output file
-    with open(result_file, 'w') as write:
-        # process each expression
-        for expr in expressions:
-            # strip whitespace
-            expr = expr.strip()
-            write.write(f"Expression: {expr}\n")
-
-            # tokenizer and write to file
-            tokens = tokenizer(expr)
-            write.write(f"Tokens: {tokens}\n")
-
-            # parser with validation
+# Iterative calculator
+# post-order evaluation with an explicit stack, same results as calculator
+def iterative_calculator(parse_tree, bindings=None):
+    # stack: subtrees to visit and operators waiting for their operands
+    stack = [parse_tree]
+    # values: evaluated operands
+    values = []
+
+    while stack:
+        node = stack.pop()
+        # integers are their own value
+        if isinstance(node, int):
+            values.append(node)
+        # handle variables
+        elif isinstance(node, tuple) and node[0] == 'var':
+            values.append(lookup_variable(node[1], bindings))
+        # subtrees: schedule the operator after its operands (left first)
+        elif isinstance(node, tuple):
+            stack.append(node[0])
+            stack.extend(reversed(node[1:]))
+        # handle unary minus
+        elif node == 'neg':
+            values.append(-values.pop())
+        # perform the operation based on the operator
+        else:
+            right = values.pop()
+            left = values.pop()
+            if node == '+':
+                values.append(left + right)
+            elif node == '-':
+                values.append(left - right)
+            elif node == '*':
+                values.append(left * right)
+            elif node == '/':
+                if right == 0:
+                    raise ZeroDivisionError("Division by zero")
+                values.append(left / right)
+            elif node == '^':
+                values.append(left ** right)
+
+    return values[0]
+
+# Cost-bounded calculator
+# estimates the size and cost of every integer result before computing it, so
+# inputs like 9 ^ 9 ^ 9 fail fast instead of pinning a core and eating memory
+
+# default budgets per expression
+# MAX_DIGITS matches Python's int to str conversion limit, so results stay printable
+MAX_DIGITS = 4300
+MAX_BYTES = 1 << 20
+MAX_SECONDS = 1.0
+# rough cost of one 30-bit limb operation, for Karatsuba estimates (n ^ 1.585)
+SECONDS_PER_LIMB_OPERATION = 2e-9
+
+# raised when an expression goes over its budget
+class BudgetExceeded(ArithmeticError):
+    pass
+
+# sizes past this many bits are never computed, estimates stop at it
+# (the float estimates below would overflow)
+HUGE_BITS = 1 << 512
+
+# estimated seconds to build an integer of the given size by multiplication
+def estimate_seconds(bits):
+    return (min(bits, HUGE_BITS) / 30) ** 1.585 * SECONDS_PER_LIMB_OPERATION
+
+# digits of an integer of the given size, for error messages
+def describe_bits(bits):
+    if bits >= HUGE_BITS:
+        return "an astronomical number of digits"
+    return f"about {int(bits / math.log2(10))} digits"
+
+# estimated size (bits) of an integer result, None for float results
+def estimate_bits(op, left, right):
+    if not isinstance(left, int) or not isinstance(right, int):
+        return None
+    if op in '+-':
+        return max(left.bit_length(), right.bit_length()) + 1
+    if op == '*':
+        return left.bit_length() + right.bit_length()
+    if op == '^':
+        # negative exponents give floats, 0 / 1 / -1 stay small
+        if right < 0:
+            return None
+        if abs(left) <= 1:
+            return 1
+        # at least right bits, too many to estimate with floats
+        if right >= HUGE_BITS:
+            return HUGE_BITS
+        return min(math.ceil(right * math.log2(abs(left))), HUGE_BITS)
+    return None
+
+# modulus: evaluate in modular arithmetic (x mod modulus) for huge powers
+# division multiplies by the modular inverse and fails if there is none
+# exponents are not reduced (a ^ b mod m is not a ^ (b mod m) mod m): the right side
+# of ^ is evaluated exactly, under the same budgets
+def bounded_calculator(parse_tree, max_digits=MAX_DIGITS, max_bytes=MAX_BYTES,
+                       max_seconds=MAX_SECONDS, modulus=None, bindings=None):
+    start = time.perf_counter()
+    # the digit and memory budgets both limit the size of integer results
+    max_bits = None
+    if max_digits is not None:
+        max_bits = math.ceil(max_digits * math.log2(10))
+    if max_bytes is not None:
+        max_bits = min(max_bits, max_bytes * 8) if max_bits is not None else max_bytes * 8
+
+    # same traversal as iterative_calculator
+    stack = [parse_tree]
+    values = []
+    while stack:
+        # CPU budget: checked at every node
+        elapsed = time.perf_counter() - start
+        if max_seconds is not None and elapsed > max_seconds:
+            raise BudgetExceeded(f"Time budget exceeded ({max_seconds}s)")
+
+        node = stack.pop()
+        # constants
+        if isinstance(node, int):
+            values.append(node % modulus if modulus else node)
+        # handle variables
+        elif isinstance(node, tuple) and node[0] == 'var':
+            value = lookup_variable(node[1], bindings)
+            values.append(value % modulus if modulus else value)
+        # exact exponent of a modular power
+        elif isinstance(node, tuple) and node[0] == 'exponent':
+            remaining = max_seconds - elapsed if max_seconds is not None else None
+            value = bounded_calculator(node[1], max_digits, max_bytes, remaining, bindings=bindings)
+            if not isinstance(value, int):
+                raise BudgetExceeded("Modular exponent is not an integer")
+            values.append(value)
+        # modular power: the base is reduced, the exponent is not
+        elif isinstance(node, tuple) and modulus and node[0] == '^':
+            stack.append('^')
+            stack.append(('exponent', node[2]))
+            stack.append(node[1])
+        # subtrees: schedule the operator after its operands (left first)
+        elif isinstance(node, tuple):
+            stack.append(node[0])
+            stack.extend(reversed(node[1:]))
+        # handle unary minus
+        elif node == 'neg':
+            value = -values.pop()
+            values.append(value % modulus if modulus else value)
+        # modular arithmetic: every value stays below the modulus
+        elif modulus:
+            right = values.pop()
+            left = values.pop()
+            if node == '+':
+                value = left + right
+            elif node == '-':
+                value = left - right
+            elif node == '*':
+                value = left * right
+            elif node == '/':
+                try:
+                    value = left * pow(right, -1, modulus)
+                except ValueError:
+                    raise ZeroDivisionError("Division by zero")
+            elif node == '^':
+                try:
+                    value = pow(left, right, modulus)
+                except ValueError:
+                    raise ZeroDivisionError("Division by zero")
+            values.append(value % modulus)
+        # perform the operation based on the operator
+        else:
+            right = values.pop()
+            left = values.pop()
+            # check the estimated size and cost before computing
+            bits = estimate_bits(node, left, right)
+            if bits is not None and max_bits is not None and bits > max_bits:
+                raise BudgetExceeded(f"Result too large ({describe_bits(bits)})")
+            if (bits is not None and max_seconds is not None and node in '*^'
+                    and elapsed + estimate_seconds(bits) > max_seconds):
+                raise BudgetExceeded(f"Time budget exceeded ({max_seconds}s)")
             try:
-                # parser and write to file
-                parse_tree = parser(tokens)
-                write.write(f"Parse Tree: {parse_tree}\n")
-            # catch parsing errors
-            except ValueError as e:
-                # write error message to file
-                write.write(f"Error\n\n")
-                continue
+                if node == '+':
+                    values.append(left + right)
+                elif node == '-':
+                    values.append(left - right)
+                elif node == '*':
+                    values.append(left * right)
+                elif node == '/':
+                    if right == 0:
+                        raise ZeroDivisionError("Division by zero")
+                    values.append(left / right)
+                elif node == '^':
+                    values.append(left ** right)
+            # float results out of range
+            except OverflowError:
+                raise BudgetExceeded("Result out of float range")
+
+    return values[0]
+
+# operator functions used by the compiled evaluators
+# division keeps the calculator's error message
+def divide(left, right):
+    if right == 0:
+        raise ZeroDivisionError("Division by zero")
+    return left / right
+
+OPERATORS = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': divide,
+    '^': operator.pow,
+}
+
+# compile
+# turns a parse tree into a function that evaluates it without re-walking the tuples
+# the function is flat generated code, one line per operator node (v3 = v1 * v2), so
+# neither compiling nor calling it recurses, however deep the tree
+# nodes shared in a DAG (optimize) are computed once and reused
+
+# Python expression of every operator, division keeps the calculator's error message
+INLINE_OPERATORS = {
+    '+': '{} + {}',
+    '-': '{} - {}',
+    '*': '{} * {}',
+    '/': 'divide({}, {})',
+    '^': '{} ** {}',
+    'neg': '-{}',
+}
+# integer constants up to this size are written into the code, others are named
+INLINE_LIMIT = 10 ** 15
+
+def compile_tree(parse_tree):
+    # constants (integers, or folded values from optimize) become constant closures
+    if not isinstance(parse_tree, tuple):
+        return lambda value=parse_tree: value
+
+    # globals of the generated function: divide and the named constants
+    namespace = {'divide': divide}
+    lines = []
+    # id(node) -> variable holding the value of a compiled node
+    names = {}
+
+    # Python expression of an operand
+    def operand(node):
+        if isinstance(node, tuple):
+            return names[id(node)]
+        if type(node) is int and abs(node) < INLINE_LIMIT:
+            return f"({node})"
+        name = f"k{len(namespace)}"
+        namespace[name] = node
+        return name
+
+    # post-order walk with an explicit stack: (node, children_done)
+    stack = [(parse_tree, False)]
+    while stack:
+        node, children_done = stack.pop()
+        # leaves, and shared nodes compiled already
+        if not isinstance(node, tuple) or id(node) in names:
+            continue
+        # compiled functions take no arguments, so there is nothing to bind
+        if node[0] == 'var':
+            raise ValueError(f"Cannot compile variable: {node[1]}")
+        # visit the children first (left ends up on top of the stack)
+        if not children_done:
+            stack.append((node, True))
+            stack.extend((child, False) for child in reversed(node[1:]))
+            continue
+        name = f"v{len(lines)}"
+        lines.append(f"    {name} = {INLINE_OPERATORS[node[0]].format(*map(operand, node[1:]))}\n")
+        names[id(node)] = name
+
+    source = "def compiled():\n" + "".join(lines) + f"    return {names[id(parse_tree)]}\n"
+    exec(compile(source, '<compiled parse tree>', 'exec'), namespace)
+    return namespace['compiled']
+
+# Optimizer
+# hash-conses a parse tree into a DAG and folds constant subtrees ahead of time
+# nodes keep the parse tree shape, folded leaves may be floats (e.g. 10 / 4 -> 2.5)
+
+# apply one operator to constant operands
+def apply_operator(op, operands):
+    if op == 'neg':
+        return -operands[0]
+    return OPERATORS[op](*operands)
+
+# interning key of a constant
+# 0.0 == -0.0, so floats also need their sign to be told apart
+def constant_key(value):
+    if isinstance(value, float):
+        return (float, value, math.copysign(1.0, value))
+    return (type(value), value)
+
+# table: interning table, pass the same dict to share nodes between trees
+def optimize(parse_tree, table=None):
+    if table is None:
+        table = {}
+    # post-order walk with an explicit stack: (node, children_done)
+    stack = [(parse_tree, False)]
+    # results: interned nodes of finished subtrees
+    results = []
+
+    while stack:
+        node, children_done = stack.pop()
+        # constants: one shared object per (type, value)
+        if not isinstance(node, tuple):
+            results.append(table.setdefault(constant_key(node), node))
+            continue
+        # visit the children first (left ends up on top of the stack)
+        if not children_done and node[0] != 'var':
+            stack.append((node, True))
+            stack.extend((child, False) for child in reversed(node[1:]))
+            continue
 
-            # calculate and write to file
+        op = node[0]
+        # variables are leaves that cannot be folded
+        if op == 'var':
+            results.append(table.setdefault(node, node))
+            continue
+
+        arity = len(node) - 1
+        children = results[-arity:]
+        del results[-arity:]
+
+        # constant folding: every operand is already a constant
+        if not any(isinstance(child, tuple) for child in children):
             try:
-                result = calculator(parse_tree)
-                write.write(f"Result: {result}\n\n")
-            except ZeroDivisionError as e:
-                write.write(f"Error\n\n")
+                value = apply_operator(op, children)
+                results.append(table.setdefault(constant_key(value), value))
+                continue
+            # keep the node so the error is raised when the expression is evaluated
+            except ArithmeticError:
+                pass
+
+        # hash-consing: children are already interned, so their ids identify them
+        key = (op,) + tuple(id(child) for child in children)
+        shared = table.get(key)
+        if shared is None:
+            # the node keeps its children alive, so their ids stay valid
+            shared = (op,) + tuple(children)
+            table[key] = shared
+        results.append(shared)
+
+    return results[0]
+
+# evaluate an optimized DAG, shared subexpressions are calculated once
+def dag_calculator(dag, bindings=None):
+    if not isinstance(dag, tuple):
+        return dag
+    # values: id(node) -> value of the shared subexpressions evaluated so far
+    values = {}
+    stack = [(dag, False)]
+
+    while stack:
+        node, children_done = stack.pop()
+        if id(node) in values:
+            continue
+        # handle variables
+        if node[0] == 'var':
+            values[id(node)] = lookup_variable(node[1], bindings)
+            continue
+        # visit the children that are subtrees first
+        if not children_done:
+            stack.append((node, True))
+            stack.extend((child, False) for child in reversed(node[1:])
+                         if isinstance(child, tuple))
+            continue
+        operands = [values[id(child)] if isinstance(child, tuple) else child
+                    for child in node[1:]]
+        values[id(node)] = apply_operator(node[0], operands)
+
+    return values[id(dag)]
+
+# number of nodes in a tree, or of distinct nodes when unique=True
+def count_nodes(parse_tree, unique=False):
+    seen = set()
+    count = 0
+    stack = [parse_tree]
+    while stack:
+        node = stack.pop()
+        if unique:
+            if id(node) in seen:
                 continue
+            seen.add(id(node))
+        count += 1
+        if isinstance(node, tuple):
+            stack.extend(node[1:])
+    return count
+
+# Vectorized evaluation
+# evaluates one parse tree over NumPy arrays of variable bindings
+# every operator runs once over whole columns, there is no Python loop per row
+# values are float64, so integers beyond 2 ^ 53 lose precision
+# rows that would raise in calculator (division by zero, 0 ^ negative) or that
+# leave the float range are masked in the returned numpy.ma.MaskedArray
+def vector_calculator(parse_tree, bindings):
+    if numpy is None:
+        raise ImportError("vectorized evaluation requires NumPy")
+
+    # bindings: {name: column}, columns are broadcast against each other
+    columns = {name: numpy.asarray(column, dtype=numpy.float64) for name, column in bindings.items()}
+    shape = numpy.broadcast_shapes(*(column.shape for column in columns.values()))
+    no_errors = numpy.zeros(shape, dtype=bool)
+
+    # same traversal as iterative_calculator, values are (array, error mask)
+    stack = [parse_tree]
+    values = []
+    with numpy.errstate(all='ignore'):
+        while stack:
+            node = stack.pop()
+            # constants
+            # a literal too large for a float becomes inf, so its rows are masked
+            if not isinstance(node, tuple) and not isinstance(node, str):
+                try:
+                    values.append((numpy.float64(node), no_errors))
+                except OverflowError:
+                    values.append((numpy.float64(numpy.inf if node > 0 else -numpy.inf), ~no_errors))
+            # handle variables
+            elif isinstance(node, tuple) and node[0] == 'var':
+                values.append((lookup_variable(node[1], columns), no_errors))
+            # subtrees: schedule the operator after its operands (left first)
+            elif isinstance(node, tuple):
+                stack.append(node[0])
+                stack.extend(reversed(node[1:]))
+            # handle unary minus
+            elif node == 'neg':
+                value, errors = values.pop()
+                values.append((-value, errors))
+            # binary operators
+            else:
+                right, right_errors = values.pop()
+                left, left_errors = values.pop()
+                if node == '+':
+                    value = left + right
+                elif node == '-':
+                    value = left - right
+                elif node == '*':
+                    value = left * right
+                elif node == '/':
+                    value = left / right
+                elif node == '^':
+                    value = left ** right
+                # x / 0, 0 ^ -n, overflow and invalid powers give inf or nan
+                errors = left_errors | right_errors | ~numpy.isfinite(value)
+                values.append((value, errors))
+
+    value, errors = values[0]
+    value = numpy.broadcast_to(value, shape)
+    return numpy.ma.masked_array(numpy.where(errors, numpy.nan, value), mask=errors)
+
+# benchmark helpers
+# deep tree: left associative chain of + and - (like "1 + 2 - 3 + ...")
+def build_deep_tree(depth):
+    tree = 1
+    for i in range(depth):
+        tree = ('+' if i % 2 == 0 else '-', tree, i % 9 + 1)
+    return tree
+
+# wide tree: balanced tree with 2 ^ levels leaves
+def build_wide_tree(levels):
+    ops = '+-*+'
+    nodes = [i % 9 + 1 for i in range(2 ** levels)]
+    level = 0
+    # combine pairs of nodes until one root is left
+    while len(nodes) > 1:
+        op = ops[level % len(ops)]
+        nodes = [(op, nodes[i], nodes[i + 1]) for i in range(0, len(nodes), 2)]
+        level += 1
+    return nodes[0]
+
+# compare the tree walking calculators with the compiled evaluator on deep and wide trees
+# calculator recurses once per level, so the recursion limit is raised for the deep tree
+# (Python calls do not use the C stack, only the limit stops them)
+def benchmark_compiled(depth=10000, levels=10, repeat=200):
+    trees = [
+        (f"deep (depth={depth})", build_deep_tree(depth)),
+        (f"wide (leaves={2 ** levels})", build_wide_tree(levels)),
+    ]
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(limit, depth + 1000))
+    try:
+        for name, tree in trees:
+            # compile once, evaluate many times
+            start = time.perf_counter()
+            compiled = compile_tree(tree)
+            compile_time = time.perf_counter() - start
+
+            times = {}
+            results = {}
+            for evaluator, evaluate in [("calculator", calculator), ("iterative_calculator", iterative_calculator),
+                                        ("compiled", lambda tree: compiled())]:
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    results[evaluator] = evaluate(tree)
+                times[evaluator] = time.perf_counter() - start
+
+            # every evaluator must agree
+            expected = results["calculator"]
+            for evaluator, result in results.items():
+                if result != expected:
+                    raise AssertionError(f"{name}: {evaluator} result {result} != {expected}")
+
+            print(f"{name}, {repeat} runs: calculator {times['calculator']:.4f}s, "
+                  f"iterative_calculator {times['iterative_calculator']:.4f}s, "
+                  f"compiled {times['compiled']:.4f}s (+{compile_time:.4f}s compile), "
+                  f"speedup {times['calculator'] / times['compiled']:.2f}x over calculator")
+    finally:
+        sys.setrecursionlimit(limit)
+
+# Parse cache
+# bounded LRU cache in front of tokenizer + parser keyed on normalized expression text
+
+# whitespace the tokenizer skips
+WHITESPACE = re.compile(r'[ \t\n]+')
+# a space only matters between two digits ("1 2" is not "12")
+EXTRA_SPACE = re.compile(r'(?<![0-9]) | (?![0-9])')
+
+# normalize whitespace so expressions with the same tokens share a cache key
+def normalize_expression(expr):
+    return EXTRA_SPACE.sub('', WHITESPACE.sub(' ', expr))
+
+# estimated memory of a cache entry (bytes)
+def entry_size(key, tokens, parse_tree):
+    size = sys.getsizeof(key) + sys.getsizeof(tokens)
+    size += sum(sys.getsizeof(token) for token in tokens)
+    # walk the tree with a stack, integers and tuples only
+    stack = [parse_tree]
+    while stack:
+        node = stack.pop()
+        size += sys.getsizeof(node)
+        if isinstance(node, tuple):
+            stack.extend(node[1:])
+    return size
+
+class ParseCache:
+    # max_entries / max_bytes: eviction budgets, None for no limit
+    def __init__(self, max_entries=4096, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # key -> (tokens, parse_tree, size), least recently used first
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # tokens and parse tree of an expression
+    # parse_tree is None when the expression is invalid (errors are cached too)
+    # the returned token list is shared with the cache and must not be modified
+    def lookup(self, expr):
+        key = normalize_expression(expr)
+        entry = self.entries.get(key)
+        # cache hit: mark as most recently used
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[0], entry[1]
+
+        # cache miss: tokenize and parse
+        self.misses += 1
+        tokens = tokenizer(key)
+        try:
+            parse_tree = iterative_parser(tokens)
+        except (ValueError, RecursionError):
+            parse_tree = None
+        size = entry_size(key, tokens, parse_tree)
+        self.entries[key] = (tokens, parse_tree, size)
+        self.bytes += size
+        self.evict()
+        return tokens, parse_tree
+
+    # drop least recently used entries until both budgets are met
+    def evict(self):
+        while self.entries and (
+                (self.max_entries is not None and len(self.entries) > self.max_entries) or
+                (self.max_bytes is not None and self.bytes > self.max_bytes)):
+            _, (_, _, size) = self.entries.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    # hit / miss statistics
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+# Streaming pipeline
+# read -> tokenize -> parse -> evaluate -> format
+# every stage is a generator, so only one expression is held in memory at a time
+
+# size of the output chunks written to the result file (characters)
+CHUNK_SIZE = 1 << 16
+
+# read: yield stripped expressions one line at a time
+def read_stage(read):
+    for line in read:
+        yield line.strip()
+
+# tokenize: (expr, tokens)
+def tokenize_stage(expressions):
+    for expr in expressions:
+        yield expr, tokenizer(expr)
+
+# parse: (expr, tokens, parse_tree)
+# parse_tree is None when the expression is invalid
+# iterative_parser, so deeply nested machine generated input does not hit the recursion limit
+def parse_stage(tokenized):
+    for expr, tokens in tokenized:
+        try:
+            parse_tree = iterative_parser(tokens)
+        # catch parsing errors
+        except (ValueError, RecursionError):
+            parse_tree = None
+        yield expr, tokens, parse_tree
+
+# tokenize + parse through a ParseCache: (expr, tokens, parse_tree)
+def cached_parse_stage(expressions, cache):
+    for expr in expressions:
+        tokens, parse_tree = cache.lookup(expr)
+        yield expr, tokens, parse_tree
+
+# evaluate: (expr, tokens, parse_tree, result)
+# result is None when the expression could not be calculated
+# evaluate: iterative_calculator, or e.g. functools.partial(bounded_calculator, ...)
+# an evaluator that still recurses too deep fails this expression only
+def evaluate_stage(parsed, evaluate=iterative_calculator):
+    for expr, tokens, parse_tree in parsed:
+        result = None
+        if parse_tree is not None:
+            try:
+                result = evaluate(parse_tree)
+            except (ZeroDivisionError, BudgetExceeded, RecursionError):
+                pass
+        yield expr, tokens, parse_tree, result
+
+# repr() of a parse tree without recursion, so very deep trees can be printed
+def format_tree(parse_tree):
+    # repr is much faster and only fails on deep trees
+    try:
+        return repr(parse_tree)
+    except RecursionError:
+        pass
+    pieces = []
+    # stack: (True, text to write) or (False, subtree to format)
+    stack = [(False, parse_tree)]
+    while stack:
+        is_text, node = stack.pop()
+        if is_text or not isinstance(node, tuple):
+            pieces.append(node if is_text else repr(node))
+            continue
+        # '(' item, item ')' pushed in reverse order, a 1-tuple ends with ','
+        stack.append((True, ',)' if len(node) == 1 else ')'))
+        for i in range(len(node) - 1, -1, -1):
+            stack.append((False, node[i]))
+            if i:
+                stack.append((True, ', '))
+        stack.append((True, '('))
+    return ''.join(pieces)
+
+# format: one result.txt block per expression
+def format_stage(evaluated):
+    for expr, tokens, parse_tree, result in evaluated:
+        block = f"Expression: {expr}\nTokens: {tokens}\n"
+        if parse_tree is None:
+            yield block + "Error\n\n"
+        elif result is None:
+            yield block + f"Parse Tree: {format_tree(parse_tree)}\nError\n\n"
+        else:
+            yield block + f"Parse Tree: {format_tree(parse_tree)}\nResult: {result}\n\n"
+
+# write blocks in chunks instead of one small write per line
+# returns the number of blocks written
+def write_chunks(blocks, write, chunk_size=CHUNK_SIZE):
+    chunk = []
+    size = 0
+    count = 0
+    for block in blocks:
+        chunk.append(block)
+        size += len(block)
+        count += 1
+        # flush once the chunk is big enough
+        if size >= chunk_size:
+            write.write(''.join(chunk))
+            chunk = []
+            size = 0
+    # flush the rest
+    if chunk:
+        write.write(''.join(chunk))
+    return count
+
+# print throughput statistics returned by run_from_file
+def report_throughput(stats):
+    print(f"Processed {stats['expressions']} expressions ({stats['bytes']} bytes) in {stats['seconds']:.3f}s: "
+          f"{stats['expressions_per_sec']:.0f} expressions/sec, {stats['bytes_per_sec']:.0f} bytes/sec")
+    # parse cache statistics when the cache was used
+    if 'cache' in stats:
+        cache = stats['cache']
+        print(f"Parse cache: {cache['hits']} hits, {cache['misses']} misses ({cache['hit_rate']:.1%}), "
+              f"{cache['evictions']} evictions, {cache['entries']} entries, {cache['bytes']} bytes")
+
+# access and run files
+# streams the input file through the pipeline with constant memory
+# cache: optional ParseCache to reuse tokens and parse trees of repeated expressions
+# evaluate: calculator used for each parse tree (see evaluate_stage)
+def run_from_file(input_file, result_file, chunk_size=CHUNK_SIZE, cache=None, evaluate=iterative_calculator):
+    start = time.perf_counter()
+
+    # read expressions lazily and write results in chunks
+    with open(input_file, 'r') as read, open(result_file, 'w') as write:
+        expressions = read_stage(read)
+        if cache is not None:
+            parsed = cached_parse_stage(expressions, cache)
+        else:
+            parsed = parse_stage(tokenize_stage(expressions))
+        blocks = format_stage(evaluate_stage(parsed, evaluate))
+        count = write_chunks(blocks, write, chunk_size)
+
+    # throughput statistics
+    seconds = time.perf_counter() - start
+    size = os.path.getsize(input_file)
+    stats = {
+        "expressions": count,
+        "bytes": size,
+        "seconds": seconds,
+        "expressions_per_sec": count / seconds if seconds else 0.0,
+        "bytes_per_sec": size / seconds if seconds else 0.0,
+    }
+    if cache is not None:
+        stats["cache"] = cache.stats()
+    return stats
+
+# Parallel mode
+# shards the input into byte ranges that end on line boundaries and runs the
+# pipeline on each shard in a process pool, output stays in the original order
+
+# target size of one shard (bytes), keeps worker memory bounded on huge files
+SHARD_SIZE = 1 << 24
+
+# split the input file into (start, end) byte ranges ending after a newline
+def shard_file(input_file, shards):
+    size = os.path.getsize(input_file)
+    step = max(1, -(-size // shards))
+    ranges = []
+    with open(input_file, 'rb') as read:
+        start = 0
+        while start < size:
+            # jump ahead, then finish the current line
+            read.seek(min(start + step, size))
+            read.readline()
+            end = min(read.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+# worker: run the pipeline on one byte range and write it to a part file
+def process_shard(input_file, start, end, part_file, evaluate=iterative_calculator):
+    with open(input_file, 'rb') as read:
+        read.seek(start)
+        data = read.read(end - start)
+    # decode with the same newline handling as open(input_file, 'r')
+    with io.TextIOWrapper(io.BytesIO(data)) as read, open(part_file, 'w') as write:
+        blocks = format_stage(evaluate_stage(parse_stage(tokenize_stage(read_stage(read))), evaluate))
+        return write_chunks(blocks, write)
+
+# parallel version of run_from_file, writes the same result file
+# evaluate must be picklable (a module level function or functools.partial)
+def run_from_file_parallel(input_file, result_file, workers=None, evaluate=iterative_calculator):
+    start = time.perf_counter()
+    workers = workers or os.cpu_count() or 1
+    size = os.path.getsize(input_file)
+
+    # at least one shard per worker, more for large files
+    shards = max(workers, -(-size // SHARD_SIZE))
+    ranges = shard_file(input_file, shards)
+
+    count = 0
+    with tempfile.TemporaryDirectory() as parts:
+        part_files = [os.path.join(parts, f"part{i}.txt") for i in range(len(ranges))]
+        # evaluate shards concurrently
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(process_shard, input_file, begin, end, part, evaluate)
+                       for (begin, end), part in zip(ranges, part_files)]
+            for future in futures:
+                count += future.result()
+
+        # concatenate part files in their original order
+        with open(result_file, 'w') as write:
+            for part in part_files:
+                with open(part, 'r') as read:
+                    shutil.copyfileobj(read, write)
+
+    # throughput statistics
+    seconds = time.perf_counter() - start
+    return {
+        "expressions": count,
+        "bytes": size,
+        "seconds": seconds,
+        "expressions_per_sec": count / seconds if seconds else 0.0,
+        "bytes_per_sec": size / seconds if seconds else 0.0,
+    }
 
 # run the program
-run_from_file('expressions.txt', 'result.txt')
\ No newline at end of file
+if __name__ == '__main__':
+    # command line options
+    arguments = argparse.ArgumentParser(description="Parse tree based arithmetic expression evaluator")
+    arguments.add_argument('--benchmark', action='store_true', help="compare calculator with compiled evaluators")
+    arguments.add_argument('--input', default='expressions.txt', help="expression file (default: expressions.txt)")
+    arguments.add_argument('--output', default='result.txt', help="result file (default: result.txt)")
+    arguments.add_argument('--workers', type=int, default=1, help="evaluate in N processes (0 = one per core)")
+    arguments.add_argument('--cache', type=int, default=0, metavar='ENTRIES', help="cache up to N parse trees (serial mode)")
+    arguments.add_argument('--cache-bytes', type=int, default=None, help="byte budget for the parse cache")
+    arguments.add_argument('--bounded', action='store_true', help="report expressions over the budgets below as errors")
+    arguments.add_argument('--max-digits', type=int, default=MAX_DIGITS, help="digit budget per expression (bounded)")
+    arguments.add_argument('--max-bytes', type=int, default=MAX_BYTES, help="memory budget per expression (bounded)")
+    arguments.add_argument('--max-seconds', type=float, default=MAX_SECONDS, help="CPU budget per expression (bounded)")
+    arguments.add_argument('--modulus', type=int, default=None, help="evaluate modulo M (bounded)")
+    args = arguments.parse_args()
+
+    # calculator used by run_from_file
+    evaluate = iterative_calculator
+    if args.bounded or args.modulus:
+        evaluate = functools.partial(bounded_calculator, max_digits=args.max_digits, max_bytes=args.max_bytes,
+                                     max_seconds=args.max_seconds, modulus=args.modulus)
+
+    if args.benchmark:
+        benchmark_compiled()
+    elif args.workers != 1:
+        report_throughput(run_from_file_parallel(args.input, args.output, args.workers, evaluate))
+    else:
+        # parse cache is off unless an entry or byte budget is given
+        cache = None
+        if args.cache or args.cache_bytes:
+            cache = ParseCache(max_entries=args.cache or None, max_bytes=args.cache_bytes)
+        report_throughput(run_from_file(args.input, args.output, cache=cache, evaluate=evaluate))
\ No newline at end of file
@@ -0,0 +1,126 @@
+# Regression tests for the expression evaluator in main.py and the benchmark helpers
+# failures raise AssertionError explicitly, so the tests also run under python -O
+# usage: python test_evaluator.py   (or python -m pytest test_evaluator.py)
+
+import argparse
+import os
+import sys
+import tempfile
+
+import benchmark
+import main
+
+# Helpers
+
+# fail with a message unless actual == expected
+def expect(actual, expected, what):
+    if actual != expected:
+        raise AssertionError(f"{what}: got {actual!r}, expected {expected!r}")
+
+# fail unless fn() raises error
+def expect_error(error, fn, what):
+    try:
+        fn()
+    except error:
+        return
+    raise AssertionError(f"{what}: {error.__name__} was not raised")
+
+# parse tree of an expression
+def tree(expr, variables=False):
+    return main.parser(main.tokenizer(expr, variables), variables)
+
+# evaluate with bounded_calculator, exceptions are returned by type
+def bounded(expr, **budgets):
+    try:
+        return main.bounded_calculator(tree(expr), **budgets)
+    except (ZeroDivisionError, main.BudgetExceeded) as error:
+        return type(error)
+
+# Batch pipeline
+
+# deeply nested lines are parsed, evaluated and printed without recursion,
+# and the lines around them are unaffected
+def test_deep_batch():
+    lines = ['1 + 2', '(' * 5000 + '1' + ')' * 5000, '-' * 100000 + '3', '1 ^ ' * 100000 + '2', '1 +']
+    with tempfile.TemporaryDirectory() as directory:
+        input_file = os.path.join(directory, 'expressions.txt')
+        with open(input_file, 'w') as write:
+            write.write('\n'.join(lines) + '\n')
+        outputs = []
+        for name, run in [('serial', lambda output: main.run_from_file(input_file, output)),
+                          ('cached', lambda output: main.run_from_file(input_file, output, cache=main.ParseCache())),
+                          ('parallel', lambda output: main.run_from_file_parallel(input_file, output, workers=2))]:
+            output = os.path.join(directory, name + '.txt')
+            expect(run(output)['expressions'], len(lines), f"{name} expressions")
+            with open(output) as read:
+                outputs.append(read.read())
+        expect(outputs[1], outputs[0], "cached output")
+        expect(outputs[2], outputs[0], "parallel output")
+    results = [line for line in outputs[0].split('\n') if line.startswith(('Result', 'Error'))]
+    expect(results, ['Result: 3', 'Result: 1', 'Result: 3', 'Result: 1', 'Error'], "results")
+
+# format_tree writes what repr would, also past the recursion limit
+def test_format_tree():
+    deep = main.iterative_parser(main.tokenizer('(x * -(2 ^ (' * 2000 + '7' + '))) + 1' * 2000, True), True)
+    formatted = main.format_tree(deep)
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(30000)
+    try:
+        expected = repr(deep)
+    finally:
+        sys.setrecursionlimit(limit)
+    expect(formatted, expected, "deep tree text")
+    expect(main.format_tree(('+', 1, ('neg', ('var', 'a')))), "('+', 1, ('neg', ('var', 'a')))", "small tree text")
+
+# Bounded calculator
+
+# modular powers reduce the base, never the exponent
+def test_modular_powers():
+    expect(bounded('2 ^ 8', modulus=7), 4, "2 ^ 8 mod 7")
+    expect(bounded('2 ^ -1', modulus=7), 4, "2 ^ -1 mod 7")
+    expect(bounded('3 ^ 2 ^ 3', modulus=7), pow(3, 8, 7), "3 ^ 2 ^ 3 mod 7")
+    expect(bounded('2 ^ 2 ^ 2000', modulus=7), pow(2, 2 ** 2000, 7), "2 ^ 2 ^ 2000 mod 7")
+
+# power towers go over the budget instead of overflowing the size estimate
+def test_power_towers():
+    expect(bounded('2 ^ 2 ^ 2000'), main.BudgetExceeded, "2 ^ 2 ^ 2000")
+    expect(bounded('2 ^ 2 ^ 2 ^ 2000', modulus=7), main.BudgetExceeded, "2 ^ 2 ^ 2 ^ 2000 mod 7")
+
+# a tower in a batch is reported as an error, the batch goes on
+def test_tower_in_batch():
+    parsed = [(expr, None, tree(expr)) for expr in ['2 ^ 2 ^ 2000', '1 + 2']]
+    evaluated = list(main.evaluate_stage(parsed, main.bounded_calculator))
+    expect([result for _, _, _, result in evaluated], [None, 3], "batch results")
+
+# Compiled evaluator
+
+# deep trees compile and run without recursion
+def test_compile_deep_tree():
+    deep = main.build_deep_tree(20000)
+    expect(main.compile_tree(deep)(), main.iterative_calculator(deep), "compiled deep tree")
+
+# Vectorized evaluator
+
+# literals too large for a float mask their rows instead of raising
+def test_vector_huge_literals():
+    if main.numpy is None:
+        return
+    for expr in ['a + 1' + '0' * 400, '-1' + '0' * 400 + ' * a']:
+        result = main.vector_calculator(tree(expr, variables=True), {'a': [1.0, 2.0]})
+        expect(bool(result.mask.all()), True, f"mask of {expr[:10]}...")
+
+# Benchmark corpus
+
+# an operator mix needs a binary operator
+def test_operator_mix():
+    for text in ['^=1', '+=0,^=1', '+=x', '%=1', '+=-1']:
+        expect_error(argparse.ArgumentTypeError, lambda: benchmark.parse_mix(text), f"--mix {text!r}")
+    expect(len(benchmark.generate_corpus(5, mix=benchmark.parse_mix('+=1,^=2'), seed=1)), 5, "corpus size")
+
+# run every test
+if __name__ == '__main__':
+    tests = [(name, fn) for name, fn in globals().items() if name.startswith('test_') and callable(fn)]
+    for name, fn in tests:
+        fn()
+        print(f"{name}: ok")
+    print(f"{len(tests)} tests passed")
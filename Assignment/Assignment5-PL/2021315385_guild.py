@@ -3,9 +3,66 @@
 
 import random
 import datetime
+import array
+import collections.abc
+import bisect
+import heapq
+import itertools
 import hashlib
+import hmac
+import inspect
 import json
 import os
+import argparse
+import threading
+import sqlite3
+import urllib.parse
+import asyncio
+import concurrent.futures
+import contextvars
+import contextlib
+import sys
+import time
+
+# Session I/O
+# menus read and write through ask() / say(), which use the console unless the
+# current session (e.g. a network connection) provides its own I/O
+session_io = contextvars.ContextVar('session_io', default=None)
+
+# read one line of input
+def ask(prompt=""):
+    io = session_io.get()
+    if io is None:
+        return input(prompt)
+    return io.ask(prompt)
+
+# write output
+def say(*values, sep=" ", end="\n"):
+    io = session_io.get()
+    if io is None:
+        print(*values, sep=sep, end=end)
+    else:
+        io.say(sep.join(str(value) for value in values) + end)
+
+# LockTable class: one lock per key (username or quest id), created on demand
+class LockTable:
+    def __init__(self):
+        self.locks = {}
+        self.guard = threading.Lock()
+
+    def __getitem__(self, key):
+        with self.guard:
+            lock = self.locks.get(key)
+            if lock is None:
+                lock = self.locks[key] = threading.Lock()
+            return lock
+
+# locks for concurrent sessions
+# always take the user lock before the quest lock
+user_locks = LockTable()
+quest_locks = LockTable()
+# serializes storage writes and new registrations (they change the users dictionary)
+storage_lock = threading.RLock()
 
 # create or load json files
 def load(json_file):
@@ -28,7 +85,936 @@ def load(json_file):
 # save data to json files
 def save(json_file, data):
     with open(json_file, 'w') as file:
-        json.dump(data, file, indent = 4)
+        json.dump(data, file, indent = 4, default = plain)
+
+# save atomically: write a temporary file, then replace the old one
+# a crash never leaves a half written snapshot behind
+def save_atomic(json_file, data):
+    temp_file = json_file + '.tmp'
+    with open(temp_file, 'w') as file:
+        json.dump(data, file, indent = 4, default = plain)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_file, json_file)
+
+# Storage backends
+# every backend loads the users and quests dictionaries at startup and
+# persists the changes of one action at a time through commit()
+class Storage:
+    # load all users and quests: returns (users, quests)
+    def load(self):
+        raise NotImplementedError
+
+    # persist one action: changed profiles and quests by username / quest id
+    def commit(self, changed_users, changed_quests):
+        raise NotImplementedError
+
+    # the completed lists of these users were rewritten in place (migration)
+    # backends that only append new entries must write them again on the next commit
+    def rewritten(self, usernames):
+        pass
+
+    # (exp, fame, rank) by username of the stored adventurers not in skip, read without
+    # loading their profiles; None if every profile is in memory anyway (users is a dict)
+    def scores(self, skip):
+        return None
+
+    # item -> count over the stored inventories of the adventurers not in skip, None like scores()
+    def item_counts(self, skip):
+        return None
+
+    def close(self):
+        pass
+
+# JsonStorage class: rewrites the whole json files on every action
+class JsonStorage(Storage):
+    def __init__(self, users_file='adventurers.json', quests_file='quests.json'):
+        self.users_file = users_file
+        self.quests_file = quests_file
+        self.users = {}
+        self.quests = {}
+
+    def load(self):
+        self.users = load(self.users_file)
+        self.quests = load(self.quests_file)
+        return self.users, self.quests
+
+    def commit(self, changed_users, changed_quests):
+        # changes are already in the loaded dictionaries (they are users and quests),
+        # only new entries are added: changed_users may hold copies (see commit())
+        for username, profile in changed_users.items():
+            self.users.setdefault(username, profile)
+        self.quests.update(changed_quests)
+        if changed_users:
+            save(self.users_file, self.users)
+        if changed_quests:
+            save(self.quests_file, self.quests)
+
+# Journal class for append-only storage
+# every action appends one record with the profiles and quests it changed
+# state = snapshot (adventurers.json + quests.json) + replayed journal records
+# a profile is recorded whole the first time this process changes it, then as deltas of
+# the fields that changed (see delta()); quests are recorded whole
+# deltas set fields and carry the position of new completed entries, so replaying a
+# record twice is harmless
+class Journal(Storage):
+    def __init__(self, path='guild.journal', threshold=1 << 20,
+                 users_file='adventurers.json', quests_file='quests.json'):
+        self.path = path
+        # journal being compacted into the snapshot
+        self.compacting_path = path + '.1'
+        # compact once the journal grows past this many bytes
+        self.threshold = threshold
+        self.users_file = users_file
+        self.quests_file = quests_file
+        self.lock = threading.Lock()
+        self.compactor = None
+        self.file = open(self.path, 'a')
+        # username -> (serialized fields except completed, length of completed) as last recorded
+        self.recorded = {}
+
+    # apply journal records to the users and quests dictionaries
+    @staticmethod
+    def apply(path, users, quests):
+        if not os.path.isfile(path):
+            return 0
+        count = 0
+        with open(path, 'r') as file:
+            for line in file:
+                # a crash can leave a partial last line, skip it
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                users.update(record.get('users', {}))
+                for username, delta in record.get('deltas', {}).items():
+                    profile = users[username]
+                    for field, value in delta.items():
+                        if field == 'completed+':
+                            position, entries = value
+                            del profile['completed'][position:]
+                            profile['completed'].extend(entries)
+                        else:
+                            profile[field] = value
+                quests.update(record.get('quests', {}))
+                count += 1
+        return count
+
+    # rebuild state on startup: snapshot + unfinished compaction + journal
+    def replay(self, users, quests):
+        count = self.apply(self.compacting_path, users, quests)
+        count += self.apply(self.path, users, quests)
+        return count
+
+    def load(self):
+        users = load(self.users_file)
+        quests = load(self.quests_file)
+        self.replay(users, quests)
+        return users, quests
+
+    def commit(self, changed_users, changed_quests):
+        self.append(changed_users, changed_quests)
+
+    # completed lists rewritten in place are recorded whole again
+    def rewritten(self, usernames):
+        with self.lock:
+            for username in usernames:
+                self.recorded.pop(username, None)
+
+    # changes of a profile since it was last recorded (called with the lock held)
+    # {field: value} for the fields that changed, "completed+": [position, new entries] for
+    # the append-only completed list; None if the profile must be recorded whole
+    def delta(self, username, profile):
+        fields = {field: json.dumps(value, separators=(',', ':'), default=plain)
+                  for field, value in profile.items() if field != 'completed'}
+        completed = profile['completed']
+        recorded = self.recorded.get(username)
+        self.recorded[username] = (fields, len(completed))
+        # first change of this process, or a field was removed
+        if recorded is None or not recorded[0].keys() <= fields.keys():
+            return None
+        recorded_fields, recorded_completed = recorded
+        delta = {field: profile[field] for field, text in fields.items() if recorded_fields.get(field) != text}
+        if len(completed) < recorded_completed:
+            delta['completed'] = completed
+        elif len(completed) > recorded_completed:
+            delta['completed+'] = [recorded_completed, completed[recorded_completed:]]
+        return delta
+
+    # append one action's changes
+    def append(self, changed_users, changed_quests):
+        with self.lock:
+            record = {}
+            for username, profile in changed_users.items():
+                delta = self.delta(username, profile)
+                if delta is None:
+                    record.setdefault('users', {})[username] = profile
+                elif delta:
+                    record.setdefault('deltas', {})[username] = delta
+            if changed_quests:
+                record['quests'] = changed_quests
+            if not record:
+                return
+            line = json.dumps(record, separators=(',', ':'), default=plain) + '\n'
+            self.file.write(line)
+            self.file.flush()
+            if self.file.tell() >= self.threshold:
+                self.start_compaction()
+
+    # rotate the journal and fold it into the snapshot in the background
+    # (called with the lock held)
+    def start_compaction(self):
+        # one compaction at a time, the journal keeps growing meanwhile
+        if self.compactor is not None and self.compactor.is_alive():
+            return
+        self.file.close()
+        os.replace(self.path, self.compacting_path)
+        self.file = open(self.path, 'a')
+        self.compactor = threading.Thread(target=self.compact, name='journal-compaction')
+        self.compactor.start()
+
+    # build a new snapshot from the old snapshot files and the rotated journal
+    # reads only files, never the live dictionaries
+    def compact(self):
+        users = load(self.users_file)
+        quests = load(self.quests_file)
+        self.apply(self.compacting_path, users, quests)
+        save_atomic(self.users_file, users)
+        save_atomic(self.quests_file, quests)
+        # the snapshot now holds everything in the rotated journal
+        os.remove(self.compacting_path)
+
+    # wait for a running compaction and close the journal
+    def close(self):
+        with self.lock:
+            compactor = self.compactor
+            self.file.close()
+        if compactor is not None:
+            compactor.join()
+
+# SQLiteStorage class: users, skills, inventory, history and quests in tables keyed by username / quest id
+# startup reads only usernames and IDs, a profile is read by its primary key the first time
+# it is used (LazyUsers); quests are read whole, the quest index and expiry heap keep them in memory
+# one commit() is one transaction, so accept and submit are atomic
+# history and completed lists are append-only, only new entries are inserted
+class SQLiteStorage(Storage):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY, id INTEGER UNIQUE NOT NULL,
+            pwd TEXT, pin TEXT, rank TEXT, exp INTEGER, fame INTEGER, stamina INTEGER);
+        CREATE TABLE IF NOT EXISTS skills (
+            username TEXT, skill TEXT, level INTEGER,
+            PRIMARY KEY (username, skill)) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS inventory (
+            username TEXT, item TEXT, count INTEGER,
+            PRIMARY KEY (username, item)) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS accepted (
+            username TEXT, position INTEGER, quest_id TEXT,
+            PRIMARY KEY (username, position)) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS completed (
+            username TEXT, position INTEGER, quest TEXT,
+            PRIMARY KEY (username, position)) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS history (
+            username TEXT, position INTEGER, type TEXT, date TEXT, details TEXT,
+            PRIMARY KEY (username, position)) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS quests (
+            quest_id TEXT PRIMARY KEY, title TEXT, difficulty TEXT,
+            skill TEXT, level INTEGER, due_date TEXT,
+            exp INTEGER, fame INTEGER, loot TEXT, required_proofs TEXT, accepted TEXT);
+        DROP INDEX IF EXISTS quests_by_requirement;
+        DROP INDEX IF EXISTS quests_by_due_date;
+        DROP INDEX IF EXISTS quests_by_accepted;
+        DROP INDEX IF EXISTS history_by_date;
+    """
+
+    def __init__(self, path='guild.db'):
+        self.path = path
+        # check_same_thread=False: used from server threads, guarded by self.lock
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(self.SCHEMA)
+        self.lock = threading.Lock()
+        # number of history / completed entries already stored per user
+        self.stored = {}
+
+    def load(self):
+        with self.lock:
+            index = dict(self.connection.execute("SELECT username, id FROM users"))
+            quests = {}
+            for (qid, title, difficulty, skill, level, due_date,
+                 exp, fame, loot, proofs, accepted_by) in self.connection.execute("SELECT * FROM quests"):
+                quests[qid] = {
+                    "title": title, "difficulty": difficulty,
+                    "require": {"skill": skill, "level": level},
+                    "due_date": due_date,
+                    "rewards": {"exp": exp, "fame": fame, "loot": json.loads(loot)},
+                    "required_proofs": json.loads(proofs),
+                    "accepted": accepted_by,
+                }
+        return LazyUsers(self, index), quests
+
+    # one profile, read by username (primary key of every table)
+    def load_profile(self, username):
+        execute = self.connection.execute
+        with self.lock:
+            user_id, pwd, pin, rank, exp, fame, stamina = execute(
+                "SELECT id, pwd, pin, rank, exp, fame, stamina FROM users WHERE username = ?", (username,)).fetchone()
+            profile = {
+                "id": user_id, "pwd": pwd, "pin": pin, "rank": rank,
+                "exp": exp, "fame": fame, "stamina": stamina,
+                "skills": dict(execute("SELECT skill, level FROM skills WHERE username = ?", (username,))),
+                "inventory": dict(execute("SELECT item, count FROM inventory WHERE username = ?", (username,))),
+                "accepted": [qid for (qid,) in execute(
+                    "SELECT quest_id FROM accepted WHERE username = ? ORDER BY position", (username,))],
+                "completed": [json.loads(quest) for (quest,) in execute(
+                    "SELECT quest FROM completed WHERE username = ? ORDER BY position", (username,))],
+            }
+            # history rows from before the history store, moved there by upgrade_profile()
+            history = [dict({"type": kind, "date": date}, **json.loads(details)) for kind, date, details in execute(
+                "SELECT type, date, details FROM history WHERE username = ? ORDER BY position", (username,))]
+            if history:
+                profile["history"] = history
+            self.stored[username] = (len(history), len(profile['completed']))
+        return profile
+
+    # write one profile (inside a transaction)
+    def write_user(self, username, profile):
+        execute = self.connection.execute
+        executemany = self.connection.executemany
+        execute("INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (username, profile['id'], profile['pwd'], profile['pin'], profile['rank'],
+                 profile['exp'], profile['fame'], profile['stamina']))
+        # small per-user collections are replaced
+        execute("DELETE FROM skills WHERE username = ?", (username,))
+        executemany("INSERT INTO skills VALUES (?, ?, ?)",
+                    [(username, skill, level) for skill, level in profile['skills'].items()])
+        execute("DELETE FROM inventory WHERE username = ?", (username,))
+        executemany("INSERT INTO inventory VALUES (?, ?, ?)",
+                    [(username, item, count) for item, count in profile['inventory'].items()])
+        execute("DELETE FROM accepted WHERE username = ?", (username,))
+        executemany("INSERT INTO accepted VALUES (?, ?, ?)",
+                    [(username, position, qid) for position, qid in enumerate(profile['accepted'])])
+
+        # history and completed only grow, insert the new entries
+        stored_history, stored_completed = self.stored.get(username, (0, 0))
+        history = profile.get('history', [])
+        completed = profile['completed']
+        # rewrite if a list shrank (e.g. edited by hand before import)
+        # or was rewritten in place (stored_completed = None)
+        if stored_completed is None:
+            stored_completed = 0
+        if len(history) < stored_history:
+            execute("DELETE FROM history WHERE username = ?", (username,))
+            stored_history = 0
+        if len(completed) < stored_completed:
+            execute("DELETE FROM completed WHERE username = ?", (username,))
+            stored_completed = 0
+        executemany("INSERT OR REPLACE INTO history VALUES (?, ?, ?, ?, ?)",
+                    [(username, position, entry['type'], entry['date'],
+                      json.dumps({key: value for key, value in entry.items() if key not in ('type', 'date')}))
+                     for position, entry in enumerate(history[stored_history:], stored_history)])
+        executemany("INSERT OR REPLACE INTO completed VALUES (?, ?, ?)",
+                    [(username, position, json.dumps(quest))
+                     for position, quest in enumerate(completed[stored_completed:], stored_completed)])
+        self.stored[username] = (len(history), len(completed))
+
+    # row of one quest
+    @staticmethod
+    def quest_row(qid, quest):
+        return (qid, quest['title'], quest['difficulty'],
+                quest['require']['skill'], quest['require']['level'], quest['due_date'],
+                quest['rewards']['exp'], quest['rewards']['fame'],
+                json.dumps(quest['rewards']['loot']), json.dumps(quest['required_proofs']),
+                quest['accepted'])
+
+    def commit(self, changed_users, changed_quests):
+        # one transaction per action, rolled back if anything fails
+        with self.lock, self.connection:
+            for username, profile in changed_users.items():
+                self.write_user(username, profile)
+            self.connection.executemany("INSERT OR REPLACE INTO quests VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                        [self.quest_row(qid, quest) for qid, quest in changed_quests.items()])
+
+    def rewritten(self, usernames):
+        for username in usernames:
+            if username in self.stored:
+                self.stored[username] = (self.stored[username][0], None)
+
+    def scores(self, skip):
+        with self.lock:
+            return {username: (exp, fame, rank) for username, exp, fame, rank in self.connection.execute(
+                "SELECT username, exp, fame, rank FROM users") if username not in skip}
+
+    # summed by SQLite, minus the rows of the skipped adventurers (under the lock, no commit in between)
+    def item_counts(self, skip):
+        execute = self.connection.execute
+        with self.lock:
+            totals = collections.Counter(dict(execute("SELECT item, SUM(count) FROM inventory GROUP BY item")))
+            for username in skip:
+                totals.subtract(dict(execute("SELECT item, count FROM inventory WHERE username = ?", (username,))))
+        return totals
+
+    # import the json files into the database
+    def import_json(self, users_file='adventurers.json', quests_file='quests.json'):
+        self.commit(load(users_file), load(quests_file))
+
+    # export the database to the json files (profiles as stored, not upgraded)
+    def export_json(self, users_file='adventurers.json', quests_file='quests.json'):
+        index, quests = self.load()
+        save_atomic(users_file, {username: self.load_profile(username) for username in index})
+        save_atomic(quests_file, quests)
+
+    def close(self):
+        self.connection.close()
+
+# LazyUsers class: users dictionary of a lazy backend (ShardedStorage, SQLiteStorage)
+# usernames and IDs come from a compact index, a profile is read from storage
+# (and upgraded) the first time it is looked up
+class LazyUsers(collections.abc.MutableMapping):
+    def __init__(self, storage, index):
+        self.storage = storage
+        # username -> id
+        self.index = index
+        # profiles loaded so far
+        self.profiles = {}
+        self.lock = threading.RLock()
+
+    # answered by the index, no profile is loaded
+    def __contains__(self, username):
+        return username in self.index
+
+    def __getitem__(self, username):
+        with self.lock:
+            if username not in self.profiles:
+                if username not in self.index:
+                    raise KeyError(username)
+                profile = self.storage.load_profile(username)
+                changed = upgrade_profile(username, profile)
+                self.profiles[username] = Adventurer(profile)
+                if changed:
+                    self.storage.rewritten([username])
+                    self.storage.commit({username: self.profiles[username]}, {})
+            return self.profiles[username]
+
+    def __setitem__(self, username, profile):
+        with self.lock:
+            self.profiles[username] = profile
+            self.index[username] = profile['id']
+
+    def __delitem__(self, username):
+        with self.lock:
+            del self.index[username]
+            self.profiles.pop(username, None)
+
+    def __iter__(self):
+        return iter(list(self.index))
+
+    def __len__(self):
+        return len(self.index)
+
+    # IDs of all adventurers, without loading profiles
+    def ids(self):
+        return list(self.index.values())
+
+    # (username, profile) of the profiles loaded so far
+    def loaded(self):
+        with self.lock:
+            return list(self.profiles.items())
+
+# ShardedStorage class: one json file per profile, read when the profile is first used
+# profiles/<shard>/<sha256 of username>.json, shard = first 2 hex digits
+# profiles/index.tsv: one "id<TAB>username" line per adventurer, appended on registration
+# (validate_username() rejects control characters, so a username never holds a tab or newline)
+# quests.json is loaded and rewritten whole, like JsonStorage
+class ShardedStorage(Storage):
+    def __init__(self, root='profiles', users_file='adventurers.json', quests_file='quests.json'):
+        self.root = root
+        self.index_file = os.path.join(root, 'index.tsv')
+        self.users_file = users_file
+        self.quests_file = quests_file
+        self.quests = {}
+        self.lock = threading.Lock()
+
+    def profile_path(self, username):
+        digest = hashlib.sha256(username.encode()).hexdigest()
+        return os.path.join(self.root, digest[:2], digest + '.json')
+
+    # username -> id of every adventurer in the index
+    def read_index(self):
+        index = {}
+        with open(self.index_file, 'r') as file:
+            for line in file:
+                # a crash can leave a partial last line, skip it
+                if not line.endswith('\n'):
+                    continue
+                user_id, username = line[:-1].split('\t', 1)
+                index[username] = int(user_id)
+        return index
+
+    def load(self):
+        # first use: split adventurers.json, if there is one
+        if not os.path.isfile(self.index_file):
+            self.import_json()
+        index = self.read_index()
+        self.quests = load(self.quests_file)
+        return LazyUsers(self, index), self.quests
+
+    def load_profile(self, username):
+        with open(self.profile_path(username), 'r') as file:
+            return json.load(file)
+
+    # (username, profile) of the adventurers not in skip, read one at a time and not kept
+    def stored_profiles(self, skip):
+        for username in self.read_index():
+            if username not in skip:
+                yield username, self.load_profile(username)
+
+    def scores(self, skip):
+        return {username: (profile['exp'], profile['fame'], profile['rank'])
+                for username, profile in self.stored_profiles(skip)}
+
+    def item_counts(self, skip):
+        totals = collections.Counter()
+        for _, profile in self.stored_profiles(skip):
+            totals.update(profile['inventory'])
+        return totals
+
+    # write changed profiles one file each, new ones are added to the index
+    def commit(self, changed_users, changed_quests):
+        with self.lock:
+            for username, profile in changed_users.items():
+                path = self.profile_path(username)
+                new = not os.path.isfile(path)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                save_atomic(path, profile)
+                if new:
+                    with open(self.index_file, 'a') as file:
+                        file.write(f"{profile['id']}\t{username}\n")
+            if changed_quests:
+                self.quests.update(changed_quests)
+                save(self.quests_file, self.quests)
+
+    # split adventurers.json into profile files
+    # the index is written last, an interrupted import is simply done again
+    def import_json(self):
+        os.makedirs(self.root, exist_ok=True)
+        users = load(self.users_file) if os.path.isfile(self.users_file) else {}
+        lines = []
+        for username, profile in users.items():
+            path = self.profile_path(username)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            save(path, profile)
+            lines.append(f"{profile['id']}\t{username}\n")
+        with open(self.index_file, 'a') as file:
+            file.writelines(lines)
+
+# changes of a bulk apply not committed yet: (usernames, quest_ids), see execute_many()
+pending = contextvars.ContextVar('pending', default=None)
+
+# persist the changes of one action through the storage backend
+# usernames / quest_ids: entries changed by the action
+# copies: {username: copy of the profile} taken under the user lock (profile_copy()), saved
+# instead of the live profile when the commit runs after the lock is released
+# during a bulk apply the changes are collected and committed once at the end
+def commit(usernames=(), quest_ids=(), copies=None):
+    copies = copies or {}
+    batch = pending.get()
+    if batch is not None:
+        batch[0].update(usernames, copies)
+        batch[1].update(quest_ids)
+        return
+    changed_users = {name: users[name] for name in usernames}
+    changed_users.update(copies)
+    with storage_lock:
+        storage.commit(changed_users, {qid: quests[qid] for qid in quest_ids})
+
+# plain copy of a profile, safe to save while its session goes on changing the profile
+def profile_copy(profile):
+    return json.loads(json.dumps(profile, default=plain))
+
+# Compact adventurer model
+# profiles are Adventurer objects with __slots__ instead of dictionaries of dictionaries,
+# skills are kept in a fixed-order array and skill / item / rank names are interned
+# both behave like dictionaries (profile['skills'][skill] += exp still works)
+SKILLS = ('hunting', 'herbology', 'sword', 'alchemy', 'craft')
+SKILL_POSITIONS = {skill: position for position, skill in enumerate(SKILLS)}
+# array value of a skill the profile does not have
+NO_SKILL = -1
+
+# Skills class: skill -> level, SKILLS in an array, any other skill in a dictionary
+class Skills(collections.abc.MutableMapping):
+    __slots__ = ('levels', 'others')
+
+    def __init__(self, skills=()):
+        self.levels = array.array('q', [NO_SKILL] * len(SKILLS))
+        self.others = None
+        self.update(skills)
+
+    def __getitem__(self, skill):
+        position = SKILL_POSITIONS.get(skill)
+        if position is not None:
+            if self.levels[position] != NO_SKILL:
+                return self.levels[position]
+        elif self.others and skill in self.others:
+            return self.others[skill]
+        raise KeyError(skill)
+
+    def __setitem__(self, skill, level):
+        position = SKILL_POSITIONS.get(skill)
+        if position is not None:
+            self.levels[position] = level
+        else:
+            if self.others is None:
+                self.others = {}
+            self.others[sys.intern(skill)] = level
+
+    def __delitem__(self, skill):
+        self[skill]
+        position = SKILL_POSITIONS.get(skill)
+        if position is not None:
+            self.levels[position] = NO_SKILL
+        else:
+            del self.others[skill]
+
+    def __iter__(self):
+        for skill, level in zip(SKILLS, self.levels):
+            if level != NO_SKILL:
+                yield skill
+        if self.others:
+            yield from self.others
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+# Adventurer class: one profile
+# fields outside FIELDS (e.g. added by hand) are kept in a dictionary
+class Adventurer(collections.abc.MutableMapping):
+    FIELDS = ('id', 'pwd', 'pin', 'rank', 'exp', 'fame', 'stamina', 'skills', 'inventory', 'accepted', 'completed')
+    __slots__ = FIELDS + ('others',)
+
+    # profile: dictionary with the fields of a profile
+    def __init__(self, profile):
+        self.others = None
+        self.update(profile)
+
+    def __getitem__(self, key):
+        if key in Adventurer.FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self.others and key in self.others:
+            return self.others[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        # compact forms of the collections
+        if key == 'skills' and not isinstance(value, Skills):
+            value = Skills(value)
+        elif key == 'inventory' and not isinstance(value, Inventory):
+            value = Inventory({sys.intern(item): count for item, count in value.items()})
+        elif key == 'accepted':
+            value = [sys.intern(qid) for qid in value]
+        elif key == 'completed':
+            value = [interned_ref(ref) for ref in value]
+        elif key == 'rank':
+            value = sys.intern(value)
+        if key in Adventurer.FIELDS:
+            setattr(self, key, value)
+        else:
+            if self.others is None:
+                self.others = {}
+            self.others[key] = value
+
+    def __delitem__(self, key):
+        self[key]
+        if key in Adventurer.FIELDS:
+            delattr(self, key)
+        else:
+            del self.others[key]
+
+    def __iter__(self):
+        for key in Adventurer.FIELDS:
+            if hasattr(self, key):
+                yield key
+        if self.others:
+            yield from self.others
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+# completed quest reference with shared quest id and version strings
+def interned_ref(ref):
+    if isinstance(ref.get('quest_id'), str):
+        ref['quest_id'] = sys.intern(ref['quest_id'])
+    if isinstance(ref.get('version'), str):
+        ref['version'] = sys.intern(ref['version'])
+    return ref
+
+# json.dump hook: profiles and skills are written as plain objects
+def plain(value):
+    if isinstance(value, collections.abc.Mapping):
+        return dict(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+# HistoryStore class: history entries of every adventurer, outside the profiles
+# history/<digest>/ (see directory()) holds segments of up to segment_entries entries (json lines),
+# named <number>.<date of the first entry>.jsonl (.rollup.jsonl once rolled up), so paging
+# back in time opens only the segments it needs and appending opens only the newest one
+# retention_days: segments older than this are deleted (None = keep forever)
+# rollup_days: Train / Rest entries older than this are summed per day (None = never)
+class HistoryStore:
+    def __init__(self, root='history', segment_entries=256, retention_days=None, rollup_days=None):
+        self.root = root
+        self.segment_entries = segment_entries
+        self.retention_days = retention_days
+        self.rollup_days = rollup_days
+        self.lock = threading.RLock()
+        # username -> [(number, start, file name)] in time order, listed on first use
+        self.segments = {}
+        # username -> entries in the newest segment
+        self.tail_counts = {}
+
+    # file name friendly form of a date, keeps the sort order
+    @staticmethod
+    def stamp(date):
+        return date.replace(':', '').replace('.', '')
+
+    # directories are named by a digest of the username, like ShardedStorage profiles
+    # (any username is a safe name, even '.' or '..')
+    def directory(self, username):
+        digest = hashlib.sha256(username.encode()).hexdigest()
+        return os.path.join(self.root, digest[:2], digest)
+
+    # directory of a user before digests: history/<quoted username>
+    # moved to the digest directory on first use, dot-only names never had their own
+    def move_legacy(self, username):
+        if username.strip('.') == '':
+            return
+        legacy = os.path.join(self.root, urllib.parse.quote(username, safe=''))
+        directory = self.directory(username)
+        if os.path.isdir(legacy) and not os.path.exists(directory):
+            os.makedirs(os.path.dirname(directory), exist_ok=True)
+            os.replace(legacy, directory)
+
+    # segments of a user (listed once, then kept up to date)
+    def user_segments(self, username):
+        if username not in self.segments:
+            self.move_legacy(username)
+            segments = []
+            directory = self.directory(username)
+            if os.path.isdir(directory):
+                for name in os.listdir(directory):
+                    # <number>.<stamp>.jsonl or <number>.<stamp>.rollup.jsonl (see maintain()),
+                    # anything else is not a segment
+                    parts = name.split('.')
+                    if parts[0].isdigit() and parts[2:] in (['jsonl'], ['rollup', 'jsonl']):
+                        segments.append((int(parts[0]), parts[1], name))
+            segments.sort()
+            self.segments[username] = segments
+            self.tail_counts[username] = len(self.read(username, segments[-1])) if segments else 0
+            self.maintain(username)
+        return self.segments[username]
+
+    # entries of one segment, oldest first
+    def read(self, username, segment):
+        entries = []
+        with open(os.path.join(self.directory(username), segment[2]), 'r') as file:
+            for line in file:
+                # a crash can leave a partial last line, skip it
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+        return entries
+
+    # add entries of one user (oldest first)
+    def append(self, username, *entries):
+        with self.lock:
+            segments = self.user_segments(username)
+            for entry in entries:
+                # start a new segment when the newest one is full
+                if not segments or self.tail_counts[username] >= self.segment_entries:
+                    os.makedirs(self.directory(username), exist_ok=True)
+                    number = segments[-1][0] + 1 if segments else 1
+                    start = self.stamp(entry['date'])
+                    segments.append((number, start, f"{number:08d}.{start}.jsonl"))
+                    self.tail_counts[username] = 0
+                    # a segment was sealed, old ones may expire now
+                    self.maintain(username)
+                with open(os.path.join(self.directory(username), segments[-1][2]), 'a') as file:
+                    file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+                self.tail_counts[username] += 1
+
+    # newest entries first, at most count of them, and the cursor of the older ones
+    # (None when there are no older entries)
+    # before: only entries dated before this timestamp (None = latest)
+    # cursor: only entries older than the ones returned with it, entries sharing a
+    # timestamp are never skipped (a cursor is (segment number, position in the segment);
+    # a segment rolled up between two pages is read from its new start)
+    def page(self, username, count=20, before=None, cursor=None):
+        with self.lock:
+            segments = self.user_segments(username)
+            last = len(segments)
+            # skip segments starting at or after the timestamp
+            if before is not None:
+                last = bisect.bisect_left([start for _, start, _ in segments], self.stamp(before))
+            # skip segments after the cursor, its own segment is read up to the position
+            if cursor is not None:
+                last = bisect.bisect_right([number for number, _, _ in segments], cursor[0])
+            result = []
+            for segment in reversed(segments[:last]):
+                entries = self.read(username, segment)
+                end = len(entries)
+                if cursor is not None and segment[0] == cursor[0]:
+                    end = min(end, cursor[1])
+                for position in range(end - 1, -1, -1):
+                    entry = entries[position]
+                    if before is None or entry['date'] < before:
+                        # one entry past the page tells whether there are older ones
+                        if len(result) == count:
+                            return result, next_cursor
+                        result.append(entry)
+                        next_cursor = (segment[0], position)
+            return result, None
+
+    # apply retention and roll-ups to the sealed segments of a user
+    def maintain(self, username):
+        segments = self.segments[username]
+        now = datetime.datetime.now()
+        # a segment is older than a cutoff when the next one starts before it
+        if self.retention_days is not None:
+            cutoff = self.stamp((now - datetime.timedelta(days=self.retention_days)).isoformat())
+            while len(segments) > 1 and segments[1][1] < cutoff:
+                os.remove(os.path.join(self.directory(username), segments.pop(0)[2]))
+        if self.rollup_days is not None:
+            cutoff = self.stamp((now - datetime.timedelta(days=self.rollup_days)).isoformat())
+            for position in range(len(segments) - 1):
+                number, start, name = segments[position]
+                if segments[position + 1][1] >= cutoff:
+                    break
+                if name.endswith('.rollup.jsonl'):
+                    continue
+                rolled = f"{number:08d}.{start}.rollup.jsonl"
+                save_lines(os.path.join(self.directory(username), rolled), rollup(self.read(username, segments[position])))
+                os.remove(os.path.join(self.directory(username), name))
+                segments[position] = (number, start, rolled)
+
+# write json lines atomically
+def save_lines(path, entries):
+    temp_file = path + '.tmp'
+    with open(temp_file, 'w') as file:
+        for entry in entries:
+            file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_file, path)
+
+# sum Train entries per day and skill, Rest entries per day
+# other entries are kept, the result stays in date order
+def rollup(entries):
+    result = []
+    groups = {}
+    for entry in entries:
+        if entry['type'] == 'Train':
+            key = (entry['date'][:10], 'Train', entry['skill'])
+        elif entry['type'] == 'Rest':
+            key = (entry['date'][:10], 'Rest')
+        else:
+            result.append(entry)
+            continue
+        minutes = int(entry['time'].rstrip('m'))
+        if key not in groups:
+            groups[key] = dict(entry, time=minutes, rollup=0)
+            result.append(groups[key])
+        else:
+            group = groups[key]
+            group['time'] += minutes
+            if entry['type'] == 'Train':
+                group['exp'] += entry['exp']
+            else:
+                group['stamina'] += entry['stamina']
+        groups[key]['rollup'] += entry.get('rollup', 1)
+    for group in groups.values():
+        group['time'] = f"{group['time']}m"
+    return result
+
+# QuestSnapshots class: immutable versions of quest definitions, shared by completed quests
+# a completed quest is stored as {"quest_id", "version", "completed"} and the
+# version (hash of the definition) points to one snapshot in quest_snapshots.json
+# mutable fields (due date, accepted) are not part of a definition
+class QuestSnapshots:
+    FIELDS = ('title', 'difficulty', 'require', 'rewards', 'required_proofs')
+
+    def __init__(self, path='quest_snapshots.json'):
+        self.path = path
+        self.lock = threading.Lock()
+        # version -> snapshot, one object per version
+        self.snapshots = load(path)
+
+    # canonical json and version of a quest definition
+    @classmethod
+    def version(cls, quest):
+        canonical = json.dumps({field: quest[field] for field in cls.FIELDS}, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(canonical.encode()).hexdigest()[:12], canonical
+
+    # version of a quest, stores a snapshot the first time a definition is seen
+    def intern(self, quest):
+        version, canonical = self.version(quest)
+        with self.lock:
+            if version not in self.snapshots:
+                self.snapshots[version] = json.loads(canonical)
+                save_atomic(self.path, self.snapshots)
+        return version
+
+    def get(self, version):
+        return self.snapshots[version]
+
+# reference to a completed quest
+def completed_ref(qid, quest):
+    return interned_ref({"quest_id": qid, "version": quest_snapshots.intern(quest),
+                         "completed": datetime.datetime.now().isoformat(timespec="seconds")})
+
+# current quest ids by definition version and by title, built on first use
+quest_lookup = None
+
+# replace full quest copies in the completed list of a profile by references
+# the quest id of a copy is found by its definition (or title) among the current quests
+# the completion time of a copy is unknown (None)
+# returns True if the profile changed
+def migrate_completed(profile):
+    global quest_lookup
+    if not any('version' not in entry for entry in profile['completed']):
+        return False
+    if quest_lookup is None:
+        quest_lookup = ({QuestSnapshots.version(quest)[0]: qid for qid, quest in quests.items()},
+                        {quest['title']: qid for qid, quest in quests.items()})
+    by_version, by_title = quest_lookup
+    for position, entry in enumerate(profile['completed']):
+        if 'version' in entry:
+            continue
+        version = quest_snapshots.intern(entry)
+        qid = by_version.get(version, by_title.get(entry['title']))
+        profile['completed'][position] = {"quest_id": qid, "version": version, "completed": None}
+    return True
+
+# bring a profile read from storage up to date, returns True if it changed
+# history lists move to the history store, quest copies become references
+def upgrade_profile(username, profile):
+    changed = False
+    if 'history' in profile:
+        history_store.append(username, *profile.pop('history'))
+        changed = True
+    if migrate_completed(profile):
+        changed = True
+    return changed
 
 # Rank class
 class Rank:
@@ -51,48 +1037,159 @@ class Rank:
             return "SILVER"
         return "BRONZE"
     
-# Inventory class for loots
-class Inventory:
-    def __init__(self, items):
-        # items is a dictionary
-        self.items = items
+# Inventory class for loots: item -> count, merged in place
+class Inventory(collections.Counter):
+    __slots__ = ()
 
-    # overload + operator to merge loot
+    # overload + operator to merge loot into a new inventory
     def __add__(self, loot):
-        # copy the inventory to create a new dictionary
-        # used for merging then returning
-        inventory = self.items.copy()
-        # for every loot received, add its value to the existing inventory
-        for key, value in loot.items():
-            # if value exists, get it, if not, use 0
-            # add the new loot's value and add to dictionary
-            inventory[key] = inventory.get(key, 0) + value
+        # copy the inventory to create a new inventory
+        inventory = Inventory(self)
+        inventory.merge(loot)
         return inventory
 
+    # overload += operator to merge loot in place
+    def __iadd__(self, loot):
+        self.merge(loot)
+        return self
+
+    # add the counts of every loot bundle, item names are shared between inventories
+    def merge(self, *bundles):
+        for loot in bundles:
+            for item, count in loot.items():
+                item = sys.intern(item)
+                self[item] = self.get(item, 0) + count
+
+# (username, profile) of every adventurer in memory, for guild-wide counts
+# copied under storage_lock, registrations add to users from other sessions
+# a lazy backend only holds the profiles loaded so far (see Storage.scores() and item_counts())
+def loaded_profiles():
+    with storage_lock:
+        if isinstance(users, LazyUsers):
+            return users.loaded()
+        return list(users.items())
+
+# ItemTotals class: how many of every item all adventurers hold together
+# counted from the profiles on the first query, then kept up to date by give()
+class ItemTotals:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # item -> count, None until the first query
+        self.totals = None
+
+    # count every inventory (called with the lock held)
+    # profiles in memory are counted as they are, a lazy backend counts the others in storage;
+    # loot given meanwhile waits in give() and is added afterwards
+    def build(self):
+        loaded = loaded_profiles()
+        self.totals = storage.item_counts({username for username, _ in loaded}) or collections.Counter()
+        for _, profile in loaded:
+            self.totals.update(profile['inventory'])
+
+    # merge loot bundles into an adventurer's inventory
+    # (under the lock, so a first query never counts a bundle twice)
+    def give(self, inventory, *bundles):
+        with self.lock:
+            inventory.merge(*bundles)
+            if self.totals is not None:
+                for loot in bundles:
+                    self.totals.update(loot)
+
+    # count of one item in the whole guild
+    def count(self, item):
+        with self.lock:
+            if self.totals is None:
+                self.build()
+            return self.totals[item]
 
 # class to define train and resting
 # overloading the addition and subtraction operator
 class Train:
     # addition will be used for stamina addition (rest)
     def __add__(self, minutes):
-        stamina_gain = 0
-        # stamina will increase by 5 every 30 minutes
-        while minutes > 0:
-            stamina_gain += 5
-            minutes -= 30
-        return stamina_gain
+        # stamina will increase by 5 every 30 minutes (started)
+        return 5 * max(0, -(-minutes // 30))
     
     # subtraction will be used for stamina subtraction (train)
     # first 30 minutes = 5
     # every 30 minutes afterwards loses 2 additional stamina
     def __sub__(self, minutes):
-        stamina_cost = 5
-        # stamina will decrease by 2 every other 30 minutes
-        minutes -= 30
-        while minutes > 0:
-            stamina_cost += 2
-            minutes -= 30
-        return stamina_cost
+        # stamina will decrease by 2 every other 30 minutes (started)
+        return 5 + 2 * max(0, -(-(minutes - 30) // 30))
+
+# base EXP of every 30 minutes of training: 10 for the first, then 0.8 times the one before
+# multiplied step by step like the original training loop, so the EXP is exactly the same
+# ends with the first base that no longer shrinks (the smallest float, every later base is the same)
+def base_exp_steps(base_exp=10, diminishing_factor=0.8):
+    steps = [base_exp]
+    while steps[-1] * diminishing_factor != steps[-1]:
+        steps.append(steps[-1] * diminishing_factor)
+    return steps
+
+BASE_EXP_STEPS = base_exp_steps()
+
+# exp of count more 30 minute steps after trained steps
+# adding stops once a base no longer changes the sum (after at most ~170 steps),
+# every later base is smaller, so the sum would not change either
+def training_exp(trained, count):
+    exp = 0
+    for step in range(trained, min(trained + count, len(BASE_EXP_STEPS))):
+        if exp + BASE_EXP_STEPS[step] == exp:
+            break
+        exp += BASE_EXP_STEPS[step]
+    return exp
+
+# TrainingSessions class: diminishing returns of training per adventurer
+# the state of an adventurer is the number of 30 minute steps trained so far,
+# stored in training.db so it is kept across restarts
+# states of recent trainers are cached, at most max_sessions and none idle for more than ttl seconds
+class TrainingSessions:
+    def __init__(self, path='training.db', max_sessions=10000, ttl=3600):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        # username -> (steps, last use), least recently used first
+        self.sessions = collections.OrderedDict()
+        self.lock = threading.Lock()
+        # check_same_thread=False: used from server threads, guarded by self.lock
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS training (username TEXT PRIMARY KEY, steps INTEGER) WITHOUT ROWID")
+
+    # steps trained by an adventurer (called with the lock held)
+    def steps(self, username):
+        if username in self.sessions:
+            return self.sessions[username][0]
+        row = self.connection.execute("SELECT steps FROM training WHERE username = ?", (username,)).fetchone()
+        return row[0] if row else 0
+
+    # drop the least recently used and idle states (called with the lock held)
+    def evict(self, now):
+        while self.sessions:
+            steps, last_use = next(iter(self.sessions.values()))
+            if len(self.sessions) <= self.max_sessions and now - last_use < self.ttl:
+                break
+            self.sessions.popitem(last=False)
+
+    # train count 30 minute steps, returns the gained exp
+    def train(self, username, count):
+        now = time.monotonic()
+        with self.lock:
+            trained = self.steps(username)
+            exp = training_exp(trained, count)
+            # the base stays the same after the last step
+            steps = min(trained + count, len(BASE_EXP_STEPS) - 1)
+            if steps != trained:
+                with self.connection:
+                    self.connection.execute("INSERT OR REPLACE INTO training VALUES (?, ?)", (username, steps))
+            self.sessions[username] = (steps, now)
+            self.sessions.move_to_end(username)
+            self.evict(now)
+        return exp
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
 
 # check if a username already exists in the user database
 def is_username_taken(username):
@@ -113,32 +1210,160 @@ def password_check(password):
     return True
 
 # hashing password / pin
+# legacy format (unsalted SHA-256), only used to verify and migrate old hashes
 def hash(pwd):
     return hashlib.sha256(pwd.encode()).hexdigest()
 
-# generate a random unique 5 digit user ID
+# Credentials
+# passwords and PINs are stored as salted PBKDF2 hashes: pbkdf2_sha256$iterations$salt$key
+KDF_ITERATIONS = 200000
+# hashlib releases the GIL while hashing, so sessions hash in parallel in their own threads
+# (hash outside of storage_lock and the user locks, it takes long)
+# seconds a successful verification is remembered by the session
+VERIFY_TTL = 300
+# recent successful verifications of the current session
+# (username, field) -> (stored hash, fingerprint of the secret, expiry)
+verified = contextvars.ContextVar('verified', default=None)
+# fingerprints only live in memory, keyed with a random key of this process
+fingerprint_key = os.urandom(32)
+# stored instead of a hash when a profile has no password / PIN (registered by a replayed trace)
+# no secret matches it
+LOCKED_SECRET = "!"
+# set while a recorded trace is replayed, secrets are not recorded so they are not checked
+replaying = contextvars.ContextVar('replaying', default=False)
+
+# derive a key from a secret
+def kdf(secret, salt, iterations):
+    return hashlib.pbkdf2_hmac('sha256', secret.encode(), salt, iterations)
+
+# salted hash of a password / pin
+def hash_secret(secret, iterations=KDF_ITERATIONS):
+    salt = os.urandom(16)
+    key = kdf(secret, salt, iterations)
+    return f"pbkdf2_sha256${iterations}${salt.hex()}${key.hex()}"
+
+# hash stored in the legacy SHA-256 format
+def is_legacy(stored):
+    return '$' not in stored
+
+# check a secret against a stored hash (either format)
+def check_secret(secret, stored):
+    if is_legacy(stored):
+        return hmac.compare_digest(stored, hash(secret))
+    _, iterations, salt, key = stored.split('$')
+    derived = kdf(secret, bytes.fromhex(salt), int(iterations))
+    return hmac.compare_digest(derived.hex(), key)
+
+# cheap keyed digest of a verified secret
+def fingerprint(secret):
+    return hmac.new(fingerprint_key, secret.encode(), 'sha256').digest()
+
+# verify the password ('pwd') or PIN ('pin') of a user
+# a secret verified by this session within VERIFY_TTL is not hashed again
+# legacy hashes are replaced by a KDF hash once the secret is known to be right
+def verify(username, field, secret):
+    profile = users[username]
+    stored = profile[field]
+    cache = verified.get()
+    if cache is not None and (username, field) in cache:
+        cached, digest, expiry = cache[(username, field)]
+        if cached == stored and time.monotonic() < expiry and hmac.compare_digest(digest, fingerprint(secret)):
+            return True
+    if not check_secret(secret, stored):
+        return False
+    # migrate legacy hash
+    if is_legacy(stored):
+        stored = hash_secret(secret)
+        with user_locks[username]:
+            profile[field] = stored
+            commit(usernames=[username])
+    if cache is not None:
+        cache[(username, field)] = (stored, fingerprint(secret), time.monotonic() + VERIFY_TTL)
+    return True
+
+# forget the verifications of a user (logout)
+def forget(username):
+    cache = verified.get()
+    if cache is not None:
+        for field in ['pwd', 'pin']:
+            cache.pop((username, field), None)
+
+# IdAllocator class: unique, non-sequential adventurer IDs in constant time
+# the n-th ID is low + scramble(n), where scramble is a keyed permutation of
+# 0..size-1, so every ID is handed out once and no retries are needed
+# the state is kept in ids.json, counters are reserved a block at a time so that
+# not every ID needs a write (a restart skips the rest of the block)
+class IdAllocator:
+    def __init__(self, state_file='ids.json', digits=5, block=1000):
+        self.state_file = state_file
+        self.digits = digits
+        self.block = block
+        self.lock = threading.Lock()
+
+    # existing_ids: IDs already in use (e.g. random IDs of older profiles)
+    def open(self, existing_ids):
+        self.used = set(existing_ids)
+        self.state = load(self.state_file)
+        # new guild, or the ID space was widened: start a new permutation
+        # (a space is never narrowed, existing IDs would not fit)
+        if self.state.get('digits', 0) < self.digits:
+            self.state = {"digits": self.digits, "keys": [random.getrandbits(32) for _ in range(4)], "reserved": 0}
+        self.low = 10 ** (self.state['digits'] - 1)
+        self.size = 9 * self.low
+        # the Feistel network works on 2 * half bits, at least size values
+        self.half = (max(self.size - 1, 1).bit_length() + 1) // 2
+        # continue after the last reserved block
+        self.counter = self.state['reserved']
+
+    # Feistel network: a permutation of 0..2^(2 * half)-1 for any round function
+    def feistel(self, value):
+        mask = (1 << self.half) - 1
+        left, right = value >> self.half, value & mask
+        for key in self.state['keys']:
+            left, right = right, left ^ ((((right ^ key) * 0x9E3779B1) >> 7) & mask)
+        return (left << self.half) | right
+
+    # permutation of 0..size-1: walk the cycle until the value falls in range
+    def scramble(self, value):
+        value = self.feistel(value)
+        while value >= self.size:
+            value = self.feistel(value)
+        return value
+
+    def allocate(self):
+        with self.lock:
+            while True:
+                if self.counter >= self.size:
+                    raise ValueError("Adventurer ID space is full, widen it with --id-digits.")
+                # reserve the next block
+                if self.counter >= self.state['reserved']:
+                    self.state['reserved'] = self.counter + self.block
+                    save_atomic(self.state_file, self.state)
+                user_id = self.low + self.scramble(self.counter)
+                self.counter += 1
+                # skip IDs taken before the allocator existed
+                if user_id not in self.used:
+                    self.used.add(user_id)
+                    return user_id
+
+# generate a unique user ID
 def generate_unique_id():
-    # to ensure uniqueness, gather existing IDs
-    existing_ids = {users[username]["id"] for username in users}
-    # while loop to find a unique ID
-    while True:
-        # generate random 5 digit ID
-        user_id = random.randint(10000, 99999)
-        # check if ID is unique
-        if user_id not in existing_ids:
-            # if it is, return it
-            return user_id
+    return id_allocator.allocate()
+
+# hashed password / pin of a new profile
+def new_secret(secret):
+    return hash_secret(secret) if secret is not None else LOCKED_SECRET
 
 # create a user profile
-def user_profile(username, password, pin):
-    # create user profile dictionary
+# pwd / pin: already hashed (new_secret)
+def user_profile(username, pwd, pin):
+    # create user profile
     return {
-        username: {
+        username: Adventurer({
             # generate id
             "id": generate_unique_id(),
-            # hash password and pin
-            "pwd": hash(password),
-            "pin": hash(pin),
+            "pwd": pwd,
+            "pin": pin,
             "rank": "BRONZE",
             "exp": 0,
             "fame": 0,
@@ -152,89 +1377,144 @@ def user_profile(username, password, pin):
             },
             "inventory": {},
             "accepted": [],
-            "completed": [],
-            "history": []
-        }
+            "completed": []
+        })
     }
 
+# GuildError: an action was refused, the message is what the menus print
+class GuildError(Exception):
+    pass
+
+# run a check for the menus: print why the action was refused, returns True if it was
+def refused(check, *args):
+    try:
+        check(*args)
+    except GuildError as error:
+        say(error)
+        return True
+    return False
+
+# verify a password / PIN for an action
+# a replayed trace has no secrets, its actions are not verified
+def require_secret(username, field, secret, message):
+    if replaying.get():
+        return
+    if not isinstance(secret, str) or not verify(username, field, secret):
+        raise GuildError(message)
+
+# registration checks
+def validate_username(username):
+    # username cannot be blank, hold control characters (tab, newline, ...) or be taken
+    if not username:
+        raise GuildError("Username cannot be blank.")
+    if not username.isprintable():
+        raise GuildError("Username cannot contain control characters.")
+    if is_username_taken(username):
+        raise GuildError("Username already taken. Please choose another.")
+
+def validate_password(password):
+    if not isinstance(password, str) or not password_check(password):
+        raise GuildError("Password must be at least 8 characters, contain an uppercase letter, and a special character.")
+
+def validate_pin(pin):
+    if not (isinstance(pin, str) and pin.isdigit() and len(pin) == 4):
+        raise GuildError("PIN must be exactly 4 digits.")
+
+# create an adventurer
+def do_register(username, password, pin):
+    validate_username(username)
+    # a replayed registration has no secrets, nobody can log in to its profile
+    if not (replaying.get() and password is None and pin is None):
+        validate_password(password)
+        validate_pin(pin)
+    # hash password and pin before taking the lock, every commit waits for it
+    pwd, pin = new_secret(password), new_secret(pin)
+    # registrations are serialized, another session may have taken the name meanwhile
+    with storage_lock:
+        validate_username(username)
+        # update users dictionary
+        users.update(user_profile(username, pwd, pin))
+        # save users to json file
+        commit(usernames=[username])
+    # outside storage_lock: the first leaderboard query takes storage_lock while holding its own lock
+    leaderboards.update(username)
+    return {"username": username, "id": users[username]['id']}
+
+# check the credentials of an adventurer
+def do_login(username, password):
+    if username not in users:
+        raise GuildError("Username not found. Please try again.")
+    require_secret(username, 'pwd', password, "Incorrect password. Please try again.")
+    return {"username": username}
+
 # registration process
 def registration():
     # while loop for receiving all inputs
     while True:
-        print("\n--- Register ---")
+        say("\n--- Register ---")
         # get username
-        username = input("Username (0 to cancel): ").strip()
+        username = ask("Username (0 to cancel): ").strip()
         # if user inputs '0', cancel registration
         if username == '0':
-            print("Registration cancelled.\n")
+            say("Registration cancelled.\n")
             return
          # if username is blank or taken, restart loop
-        if not username:
-            print("Username cannot be blank.")
-            continue
-        if is_username_taken(username):
-            print("Username already taken. Please choose another.")
+        if refused(validate_username, username):
             continue
 
         # get password
-        password = input("Password (>=8, 1 uppercase, 1 special) (0 to cancel): ").strip()
+        password = ask("Password (>=8, 1 uppercase, 1 special) (0 to cancel): ").strip()
         # if user inputs '0', cancel registration
         if password == '0':
-            print("Registration cancelled.\n")
+            say("Registration cancelled.\n")
             return
         # check password validity
-        if not password_check(password):
-            print("Password must be at least 8 characters, contain an uppercase letter, and a special character.")
+        if refused(validate_password, password):
             continue
         
         # get 4-digit pin
-        pin = input("4-digit PIN (0 to cancel): ").strip()
+        pin = ask("4-digit PIN (0 to cancel): ").strip()
         # if user inputs '0', cancel registration
         if pin == '0':
-            print("Registration cancelled.\n")
+            say("Registration cancelled.\n")
             return
         # check pin validity
-        if not (pin.isdigit() and len(pin) == 4):
-            print("PIN must be exactly 4 digits.")
+        if refused(validate_pin, pin):
             continue
 
         # if all inputs are valid, create user profile
-        user = user_profile(username, password, pin)
-        # update users dictionary
-        users.update(user)
-        # save users to json file
-        save('adventurers.json', users)
+        result = execute({"action": "register", "username": username, "password": password, "pin": pin})
+        if not result['ok']:
+            say(result['error'])
+            continue
         
         # registration successful, break loop
-        print(f"Registration successful! Welcome, {username}. Your Adventurer ID is {users[username]['id']}.\n")
+        say(f"Registration successful! Welcome, {username}. Your Adventurer ID is {result['id']}.\n")
         break
 
 # login
 def login():
     # while loop for login attempts
     while True: 
-        print("\n--- Login ---")
+        say("\n--- Login ---")
         # get username and password
-        username = input("Username (0 to cancel): ").strip()
+        username = ask("Username (0 to cancel): ").strip()
 
         # if user inputs '0', cancel login
         if username == '0':
-            print("Login cancelled.\n")
+            say("Login cancelled.\n")
             return None
 
-        password = input("Password: ").strip()
+        password = ask("Password: ").strip()
 
         # validate credentials
-        if username not in users:
-            print("Username not found. Please try again.")
-            continue
-
-        if users[username]['pwd'] != hash(password):
-            print("Incorrect password. Please try again.")
+        result = execute({"action": "login", "username": username, "password": password})
+        if not result['ok']:
+            say(result['error'])
             continue
         
         # login successful
-        print(f"Login successful! Welcome back, {username}.\n")
+        say(f"Login successful! Welcome back, {username}.\n")
         return username
 
 # log history
@@ -248,147 +1528,597 @@ def log_history(username, action_type="", **kwargs):
 
     for bad_binding in ['type', 'date']:
         if bad_binding in kwargs:
-            print(f"Binding error: '{bad_binding}' is a reserved key and cannot be used in history logging.")
+            say(f"Binding error: '{bad_binding}' is a reserved key and cannot be used in history logging.")
             return
 
     # update entry with kwarg values
     entry.update(kwargs)
-    users[username]['history'].append(entry)
+    history_store.append(username, entry)
+
 
+# entries of the history shown at a time
+HISTORY_PAGE_SIZE = 20
 
 # view history
 def history(username):
-    # get user profile
-    profile = users[username]
-    print("\n--- History (latest first) ---")
-    # iterate through history list in reverse order
-    for quest in reversed(profile['history']):
+    say("\n--- History (latest first) ---")
+    # latest page, then older pages on request
+    entries, cursor = history_store.page(username, HISTORY_PAGE_SIZE)
+    while True:
+        show_history(entries)
+        if cursor is None:
+            return
+        if ask("[>] Older entries, anything else to return: ").strip() != '>':
+            return
+        entries, cursor = history_store.page(username, HISTORY_PAGE_SIZE, cursor=cursor)
+
+# print history entries
+def show_history(entries):
+    for quest in entries:
         # display based on action type
         if quest["type"] == "Train":
-            print(f"[{quest['date']}] {quest['type']}\t{quest['skill']} +{quest['exp']} ({quest['time']})")
+            say(f"[{quest['date']}] {quest['type']}\t{quest['skill']} +{quest['exp']} ({quest['time']})")
         elif quest["type"] == "Submit":
-            print(f"[{quest['date']}] {quest['type']}\t{quest['quest_id']} EXP:{quest['exp']} Fame:{quest['fame']} Loot:{quest['loot']}")
+            say(f"[{quest['date']}] {quest['type']}\t{quest['quest_id']} EXP:{quest['exp']} Fame:{quest['fame']} Loot:{quest['loot']}")
         elif quest["type"] == "Accept":
-            print(f"[{quest['date']}] {quest['type']}\t{quest['quest_id']} difficulty={quest['difficulty']} priority={quest['priority']}")
+            say(f"[{quest['date']}] {quest['type']}\t{quest['quest_id']} difficulty={quest['difficulty']} priority={quest['priority']}")
         elif quest["type"] == "Rest":
-            print(f"[{quest['date']}] {quest['type']}\tStamina: +{quest['stamina']} ({quest['time']})")
+            say(f"[{quest['date']}] {quest['type']}\tStamina: +{quest['stamina']} ({quest['time']})")
 
-# accept quest
-def accept_quest(username):
-    profile = users[username]
-    print("\n=== Quest Board ===")
-    # display available quests
-    for quest_id, quest in quests.items():
-        require = quest['require']
-        print(f"- {quest_id}:\t'{quest['title']}'    Difficulty: {quest['difficulty']}   Req: {require['skill']}>={require['level']} Due: {quest['due_date']}")
-    # get quest id to accept
-    qid = input("Enter Quest ID to accept (0 to cancel): ").strip()
-    # if user inputs '0', cancel
-    if qid == '0':
-        print("Quest acceptance cancelled.\n")
-        return
+# QuestIndex class: available (not accepted) quests by required skill, level and difficulty
+# every bucket keeps (due date, quest id) sorted, so a query skips expired quests
+# with a binary search and merges the buckets in due date order
+# the index is updated on accept (remove) and submit (add)
+class QuestIndex:
+    def __init__(self, quests):
+        # (skill, level, difficulty) -> sorted [(due_date, qid)]
+        self.buckets = {}
+        # qid -> (bucket key, entry) of indexed quests
+        self.entries = {}
+        self.lock = threading.Lock()
+        for qid, quest in quests.items():
+            self.add(qid, quest)
+
+    # index a quest, if it is available
+    def add(self, qid, quest):
+        if quest['accepted'] is not None:
+            return
+        with self.lock:
+            if qid in self.entries:
+                self.discard(qid)
+            key = (quest['require']['skill'], quest['require']['level'], quest['difficulty'])
+            entry = (quest['due_date'], qid)
+            bisect.insort(self.buckets.setdefault(key, []), entry)
+            self.entries[qid] = (key, entry)
+
+    # index many changed quests at once: every bucket is rebuilt once
+    # instead of one insertion per quest
+    def add_many(self, changed):
+        with self.lock:
+            removed = {}
+            added = {}
+            for qid, quest in changed:
+                if qid in self.entries:
+                    key, entry = self.entries.pop(qid)
+                    removed.setdefault(key, set()).add(entry)
+                if quest['accepted'] is None:
+                    key = (quest['require']['skill'], quest['require']['level'], quest['difficulty'])
+                    entry = (quest['due_date'], qid)
+                    added.setdefault(key, []).append(entry)
+                    self.entries[qid] = (key, entry)
+            for key in removed.keys() | added.keys():
+                bucket = self.buckets.get(key, [])
+                if key in removed:
+                    bucket = [entry for entry in bucket if entry not in removed[key]]
+                bucket.extend(added.get(key, ()))
+                bucket.sort()
+                if bucket:
+                    self.buckets[key] = bucket
+                else:
+                    self.buckets.pop(key, None)
+
+    # remove a quest (accepted)
+    def remove(self, qid):
+        with self.lock:
+            self.discard(qid)
+
+    def discard(self, qid):
+        if qid not in self.entries:
+            return
+        key, entry = self.entries.pop(qid)
+        bucket = self.buckets[key]
+        del bucket[bisect.bisect_left(bucket, entry)]
+        if not bucket:
+            del self.buckets[key]
+
+    # sorted runs of the buckets that match, from due_from on
+    # skills: skill -> level of the adventurer (None = any requirement)
+    def runs(self, skills, difficulty, due_from):
+        for (skill, level, diff), bucket in self.buckets.items():
+            if skills is not None and level > skills.get(skill, 0):
+                continue
+            if difficulty is not None and diff != difficulty:
+                continue
+            start = bisect.bisect_left(bucket, (due_from,))
+            if start < len(bucket):
+                yield bucket, start
+
+    # available quests, sorted by due date: (list of quest ids of the page, total matches)
+    # due_from: earliest due date ("YYYY-MM-DD"), page: 1 = first page
+    def query(self, skills=None, difficulty=None, due_from="", page=1, page_size=10):
+        with self.lock:
+            runs = list(self.runs(skills, difficulty, due_from))
+            total = sum(len(bucket) - start for bucket, start in runs)
+            merged = heapq.merge(*(itertools.islice(bucket, start, None) for bucket, start in runs))
+            first = (page - 1) * page_size
+            return [qid for _, qid in itertools.islice(merged, first, first + page_size)], total
+
+    # quests the adventurer can accept right now
+    def eligible(self, profile, page=1, page_size=10):
+        today = datetime.date.today().strftime("%Y-%m-%d")
+        return self.query(profile['skills'], due_from=today, page=page, page_size=page_size)
+
+# ExpiryScheduler class: min-heap of quests by due date
+# tick() takes every quest due before today off the heap: an accepted quest is
+# released (removed from the adventurer's accepted list) and a quest with
+# "repeat": days gets its due date moved forward by whole periods
+# all changes of one tick are saved with one commit, of profile copies taken under the user locks
+# heap entries are (day number, quest id, due date); an entry whose date no longer
+# matches the quest is left over from an older due date and is skipped
+class ExpiryScheduler:
+    def __init__(self, quests):
+        self.quests = quests
+        self.lock = threading.Lock()
+        self.rebuild()
+
+    # heap of the current due dates (called with the lock held, or before use)
+    def rebuild(self):
+        self.heap = [(datetime.date.fromisoformat(quest['due_date']).toordinal(), qid, quest['due_date'])
+                     for qid, quest in self.quests.items()]
+        heapq.heapify(self.heap)
+
+    # the due date of quests changed
+    def schedule(self, *changed):
+        with self.lock:
+            for qid, quest in changed:
+                heapq.heappush(self.heap, (datetime.date.fromisoformat(quest['due_date']).toordinal(), qid, quest['due_date']))
+            # too many left over entries
+            if len(self.heap) > 2 * len(self.quests) + 1024:
+                self.rebuild()
+
+    # expire the quests due before today, returns how many expired
+    def tick(self, today=None):
+        today = today or datetime.date.today()
+        expired = []
+        with self.lock:
+            while self.heap and self.heap[0][0] < today.toordinal():
+                _, qid, due_date = heapq.heappop(self.heap)
+                quest = self.quests.get(qid)
+                if quest is not None and quest['due_date'] == due_date:
+                    expired.append(qid)
+        if not expired:
+            return 0
+
+        # username -> copy of the profile after its last release
+        changed_users = {}
+        changed_quests = []
+        rolled = []
+        for qid in expired:
+            quest = self.quests[qid]
+            username = quest['accepted']
+            with user_locks[username] if username is not None else contextlib.nullcontext(), quest_locks[qid]:
+                # release the quest, unless it was submitted meanwhile
+                if username is not None and quest['accepted'] == username:
+                    quest['accepted'] = None
+                    if qid in users[username]['accepted']:
+                        users[username]['accepted'].remove(qid)
+                    changed_users[username] = profile_copy(users[username])
+                # move a recurring quest to its next due date from today on
+                if quest.get('repeat'):
+                    days = datetime.date.fromisoformat(quest['due_date']).toordinal()
+                    periods = -(-(today.toordinal() - days) // quest['repeat'])
+                    quest['due_date'] = datetime.date.fromordinal(days + periods * quest['repeat']).isoformat()
+                    rolled.append((qid, quest))
+                changed_quests.append(qid)
+        # batched: one heap update, one index update and one commit
+        self.schedule(*rolled)
+        quest_index.add_many((qid, self.quests[qid]) for qid in changed_quests)
+        commit(quest_ids=changed_quests, copies=changed_users)
+        return len(expired)
+
+# SkipNode class: one entry of a RankedList
+# next[level]: following node on that level, width[level]: entries it skips over
+class SkipNode:
+    __slots__ = ('value', 'next', 'width')
+
+    def __init__(self, value, level):
+        self.value = value
+        self.next = [None] * level
+        self.width = [1] * level
+
+# RankedList class: sorted values in an indexable skip list
+# every link knows how many entries it spans, so insert, remove, the position of a
+# value and the value at a position are all O(log n)
+class RankedList:
+    MAX_LEVEL = 32
+
+    # values: sorted, linked level by level in O(n)
+    def __init__(self, values=()):
+        self.tail = SkipNode(None, 0)
+        self.head = SkipNode(None, self.MAX_LEVEL)
+        self.size = 0
+        # last node linked on every level and its position
+        last = [self.head] * self.MAX_LEVEL
+        positions = [0] * self.MAX_LEVEL
+        for value in values:
+            self.size += 1
+            node = SkipNode(value, self.random_level())
+            for level in range(len(node.next)):
+                last[level].next[level] = node
+                last[level].width[level] = self.size - positions[level]
+                last[level] = node
+                positions[level] = self.size
+        for level in range(self.MAX_LEVEL):
+            last[level].next[level] = self.tail
+            last[level].width[level] = self.size + 1 - positions[level]
+
+    # level of a new node: 1 with probability 1/2, 2 with 1/4, ...
+    def random_level(self):
+        bits = random.getrandbits(self.MAX_LEVEL - 1) | 1 << (self.MAX_LEVEL - 1)
+        return (bits & -bits).bit_length()
+
+    # last node before value on every level and its position
+    def path(self, value):
+        nodes = [None] * self.MAX_LEVEL
+        positions = [0] * self.MAX_LEVEL
+        node = self.head
+        position = 0
+        for level in reversed(range(self.MAX_LEVEL)):
+            while node.next[level] is not self.tail and node.next[level].value < value:
+                position += node.width[level]
+                node = node.next[level]
+            nodes[level] = node
+            positions[level] = position
+        return nodes, positions
+
+    def insert(self, value):
+        nodes, positions = self.path(value)
+        node = SkipNode(value, self.random_level())
+        position = positions[0] + 1
+        for level in range(self.MAX_LEVEL):
+            before = nodes[level]
+            if level < len(node.next):
+                node.next[level] = before.next[level]
+                node.width[level] = before.width[level] - (position - positions[level]) + 1
+                before.next[level] = node
+                before.width[level] = position - positions[level]
+            else:
+                before.width[level] += 1
+        self.size += 1
+
+    def remove(self, value):
+        nodes, _ = self.path(value)
+        node = nodes[0].next[0]
+        if node is self.tail or node.value != value:
+            raise ValueError(f"{value!r} is not in the list")
+        for level in range(self.MAX_LEVEL):
+            before = nodes[level]
+            if before.next[level] is node:
+                before.width[level] += node.width[level] - 1
+                before.next[level] = node.next[level]
+            else:
+                before.width[level] -= 1
+        self.size -= 1
+
+    # number of values smaller than value
+    def count_before(self, value):
+        return self.path(value)[1][0]
+
+    # value at a position (0 = smallest)
+    def __getitem__(self, index):
+        if not 0 <= index < self.size:
+            raise IndexError(index)
+        node = self.head
+        position = 0
+        for level in reversed(range(self.MAX_LEVEL)):
+            while node.next[level] is not self.tail and position + node.width[level] <= index + 1:
+                position += node.width[level]
+                node = node.next[level]
+        return node.value
+
+    def __iter__(self):
+        node = self.head.next[0]
+        while node is not self.tail:
+            yield node.value
+            node = node.next[0]
+
+    def __len__(self):
+        return self.size
+
+# Leaderboards class: adventurers ranked by EXP and by fame, and counted per rank tier
+# boards hold (-score, username), so the best adventurer comes first
+# built from the profiles on the first query, then updated by update() when a score changes
+class Leaderboards:
+    BOARDS = ('exp', 'fame')
+    TIERS = ('DIAMOND', 'PLATINUM', 'GOLD', 'SILVER', 'BRONZE')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # board -> RankedList, None until the first query
+        self.boards = None
+        # username -> (exp, fame, rank) as it is on the boards
+        self.entries = {}
+        self.tiers = collections.Counter()
+
+    # rank every adventurer (called with the lock held)
+    # profiles in memory are read as they are, a lazy backend reads the scores of the others
+    # from storage; a score changed meanwhile waits in update() and is applied afterwards
+    def build(self):
+        loaded = loaded_profiles()
+        self.entries = storage.scores({username for username, _ in loaded}) or {}
+        for username, profile in loaded:
+            self.entries[username] = (profile['exp'], profile['fame'], profile['rank'])
+        self.boards = {board: RankedList(sorted((-entry[number], username) for username, entry in self.entries.items()))
+                       for number, board in enumerate(self.BOARDS)}
+        self.tiers = collections.Counter(entry[2] for entry in self.entries.values())
+
+    # the scores of an adventurer changed (or a new adventurer registered)
+    def update(self, username):
+        profile = users[username]
+        entry = (profile['exp'], profile['fame'], profile['rank'])
+        with self.lock:
+            if self.boards is None:
+                return
+            old = self.entries.get(username)
+            if old == entry:
+                return
+            for number, board in enumerate(self.BOARDS):
+                if old is None or old[number] != entry[number]:
+                    if old is not None:
+                        self.boards[board].remove((-old[number], username))
+                    self.boards[board].insert((-entry[number], username))
+            if old is not None:
+                self.tiers[old[2]] -= 1
+            self.tiers[entry[2]] += 1
+            self.entries[username] = entry
+
+    # best count adventurers of a board: [(username, score)]
+    def top(self, board, count=10):
+        with self.lock:
+            if self.boards is None:
+                self.build()
+            return [(username, -score) for score, username in itertools.islice(self.boards[board], count)]
+
+    # place of an adventurer on a board (1 + adventurers with a higher score) and adventurers on it
+    def place(self, board, username):
+        with self.lock:
+            if self.boards is None:
+                self.build()
+            score = self.entries[username][self.BOARDS.index(board)]
+            return self.boards[board].count_before((-score, '')) + 1, len(self.boards[board])
+
+    # adventurers per rank tier, best tier first
+    def tier_counts(self):
+        with self.lock:
+            if self.boards is None:
+                self.build()
+            return {tier: self.tiers[tier] for tier in self.TIERS}
+
+# quests per page of the quest board
+QUEST_PAGE_SIZE = 10
+
+# quest that can still be accepted
+def acceptable_quest(qid):
     # check if quest id is valid
     if qid not in quests:
-        print("Invalid Quest ID. Please try again.")
-        return
+        raise GuildError("Invalid Quest ID. Please try again.")
     # check if anyone has already accepted the quest
     quest = quests[qid]
     if quest['accepted'] is not None:
-        print("This quest has already been accepted by another adventurer.")
-        return
-    
-    # get pin for verification
-    pin = input("Enter your 4-digit PIN for verification: ").strip()
-    if profile['pin'] != hash(pin):
-        print("Incorrect PIN. Quest acceptance cancelled.")
-        return
-    
+        raise GuildError("This quest has already been accepted by another adventurer.")
+    return quest
+
+# skill requirement and due date of a quest
+def check_requirements(profile, quest):
     req = quest['require']
     user_skill = profile['skills'].get(req['skill'], 0)
     # check if user meets skill requirement
     if user_skill < req['level']:
-        print(f"You do not meet the skill requirement for this quest. Required: {req['skill']} >= {req['level']}, Your level: {user_skill}.")
+        raise GuildError(f"You do not meet the skill requirement for this quest. Required: {req['skill']} >= {req['level']}, Your level: {user_skill}.")
+    # check if due date has not passed
+    # (YYYY-MM-DD strings compare like dates)
+    if quest['due_date'] < datetime.date.today().isoformat():
+        raise GuildError("The due date for this quest has already passed.")
+
+# accept a quest
+def do_accept(username, quest_id, pin, priority='NORMAL'):
+    quest = acceptable_quest(quest_id)
+    require_secret(username, 'pin', pin, "Incorrect PIN. Quest acceptance cancelled.")
+    check_requirements(users[username], quest)
+    # priority, default NORMAL
+    priority = str(priority).strip().upper()
+    if priority not in ['NORMAL', 'HIGH']:
+        priority = 'NORMAL'
+
+    # check again under the locks, another session may have accepted it meanwhile
+    with user_locks[username], quest_locks[quest_id]:
+        if quest['accepted'] is not None:
+            raise GuildError("This quest has already been accepted by another adventurer.")
+        quest['accepted'] = username
+        quest_index.remove(quest_id)
+
+        users[username]['accepted'].append(quest_id)
+        # for history tracking
+        log_history(username, action_type="Accept", quest_id=quest_id, difficulty=quest['difficulty'], priority=priority)
+
+        # save changes to json file
+        commit(usernames=[username], quest_ids=[quest_id])
+    return {"quest_id": quest_id, "priority": priority}
+
+# accept quest
+def accept_quest(username):
+    profile = users[username]
+    # display the quests this adventurer can accept, a page at a time
+    page = 1
+    while True:
+        page_qids, total = quest_index.eligible(profile, page, QUEST_PAGE_SIZE)
+        pages = max(1, -(-total // QUEST_PAGE_SIZE))
+        say(f"\n=== Quest Board (page {page}/{pages}, {total} quests available) ===")
+        for quest_id in page_qids:
+            quest = quests[quest_id]
+            require = quest['require']
+            say(f"- {quest_id}:\t'{quest['title']}'    Difficulty: {quest['difficulty']}   Req: {require['skill']}>={require['level']} Due: {quest['due_date']}")
+        # get quest id to accept, or change page
+        qid = ask("Enter Quest ID to accept (0 to cancel, > next page, < previous page): ").strip()
+        if qid == '>' and page < pages:
+            page += 1
+        elif qid == '<' and page > 1:
+            page -= 1
+        elif qid not in ('<', '>'):
+            break
+    # if user inputs '0', cancel
+    if qid == '0':
+        say("Quest acceptance cancelled.\n")
+        return
+    # check if the quest can be accepted
+    if refused(acceptable_quest, qid):
         return
     
-    # check if due date has not passed
-    due_date = datetime.datetime.strptime(quest['due_date'], "%Y-%m-%d").date()
-    if due_date < datetime.date.today():
-        print("The due date for this quest has already passed.")
+    # get pin for verification
+    pin = ask("Enter your 4-digit PIN for verification: ").strip()
+    if refused(require_secret, username, 'pin', pin, "Incorrect PIN. Quest acceptance cancelled."):
+        return
+    
+    # check skill requirement and due date
+    if refused(check_requirements, profile, quests[qid]):
         return
     
     # receive priority input, default NORMAL
-    priority = input("Priority (NORMAL / HIGH) [default: NORMAL]: ").strip().upper()
-    if priority not in ['NORMAL', 'HIGH']:
-        priority = 'NORMAL'
+    priority = ask("Priority (NORMAL / HIGH) [default: NORMAL]: ").strip().upper()
     
     # accept quest
-    quest['accepted'] = username
-
-    users[username]['accepted'].append(qid)
-    # for history tracking
-    log_history(username, action_type="Accept", quest_id=qid, difficulty=quest['difficulty'], priority=priority)
+    result = execute({"action": "accept", "username": username, "quest_id": qid, "pin": pin, "priority": priority})
+    if not result['ok']:
+        say(result['error'])
 
-    # save changes to json file
-    save('adventurers.json', users)
-    save('quests.json', quests)
-
-#  validate proof
-def validate_proofs(*proofs, required=None):
+# why proofs are not valid (None if they are)
+def proof_error(proofs, required):
     if required is None:
-        print("Binding error: There must be a 'required' proof list to validate user's submission")
-        return False
+        return "Binding error: There must be a 'required' proof list to validate user's submission"
     
     # if proofs list is empty
     if not proofs:
-        print("Binding error: No proof parameter. Provide at least one proof.")
-        return False
+        return "Binding error: No proof parameter. Provide at least one proof."
     
     # Binding errors: no duplicate proof names allowed
     if len(proofs) != len(set(proofs)):
-        print("Binding error: Duplicate proof names detected.")
-        return False
+        return "Binding error: Duplicate proof names detected."
     
     # check if all proofs are in req_proofs
     if not all(p in proofs for p in required):
-        print("You have not provided all required proof items.")
+        return "You have not provided all required proof items."
+    return None
+
+#  validate proof
+def validate_proofs(*proofs, required=None):
+    error = proof_error(proofs, required)
+    if error is not None:
+        say(error)
         return False
     return True
 
+# quest accepted by the adventurer
+def submittable(profile, qid):
+    if qid not in profile['accepted']:
+        raise GuildError("You have not accepted this quest.")
+
+# ensure due date has not passed
+def check_submission_due(quest):
+    if quest['due_date'] < datetime.date.today().isoformat():
+        raise GuildError("The due date for this quest has already passed. You cannot submit it.")
+
+# submit a quest with its proofs
+def do_submit(username, quest_id, pin, proofs=()):
+    profile = users[username]
+    submittable(profile, quest_id)
+    require_secret(username, 'pin', pin, "Incorrect PIN. Quest submission cancelled.")
+    quest = quests[quest_id]
+    check_submission_due(quest)
+    error = proof_error(tuple(proofs), quest['required_proofs'])
+    if error is not None:
+        raise GuildError(error)
+
+    # submit atomically under the user and quest locks
+    with user_locks[username], quest_locks[quest_id]:
+        # check if user has enough stamina to submit quest (10 stamina)
+        if profile['stamina'] < 10:
+            raise GuildError("You do not have enough stamina to submit this quest. Minimum 10 stamina required.")
+        # another session of this user may have submitted it meanwhile
+        submittable(profile, quest_id)
+    
+        # submit quest
+        profile['accepted'].remove(quest_id)
+        # reference to a snapshot of the quest
+        profile['completed'].append(completed_ref(quest_id, quest))
+        profile['stamina'] -= 10
+        profile['exp'] += quest['rewards']['exp']
+        # use overloaded str() in Rank class to check new rank
+        rank = str(Rank(profile['exp']))
+        # if rank changed, update rank
+        rankChange = False
+        if profile['rank'] != rank:
+            profile['rank'] = rank
+            rankChange = True
+        profile['fame'] += quest['rewards']['fame']
+        # add loot to user, in place (counted in the guild totals)
+        item_totals.give(profile['inventory'], quest['rewards']['loot'])
+        # new EXP, fame and rank on the leaderboards
+        leaderboards.update(username)
+
+        # for history tracking
+        log_history(username, action_type="Submit", quest_id=quest_id, exp=quest['rewards']['exp'], fame=quest['rewards']['fame'], loot=quest['rewards']['loot'])
+        # add quest to quests.json as unaccepted
+        quest['accepted'] = None
+        # update due date to tomorrow
+        quest['due_date'] = (datetime.date.today() + datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+        quest_index.add(quest_id, quest)
+        expiry_scheduler.schedule((quest_id, quest))
+        # save changes to json files
+        commit(usernames=[username], quest_ids=[quest_id])
+    return {"quest_id": quest_id, "exp": quest['rewards']['exp'], "fame": quest['rewards']['fame'],
+            "loot": quest['rewards']['loot'], "rank": rank, "promoted": rankChange}
+
 # submit quest
 def submit_quest(username):
     profile = users[username]
     # get quest ID input
-    qid = input("Quest to submit (0 to cancel): ").strip()
+    qid = ask("Quest to submit (0 to cancel): ").strip()
     # if user inputs '0', cancel
     if qid == '0':
-        print("Quest submission cancelled.\n")
+        say("Quest submission cancelled.\n")
         return
     # check if quest is accepted by user
-    if qid not in profile['accepted']:
-        print("You have not accepted this quest.")
+    if refused(submittable, profile, qid):
         return
 
     # get pin for verification
-    pin = input("Enter your 4-digit PIN for verification: ").strip()
-    if users[username]['pin'] != hash(pin):
-        print("Incorrect PIN. Quest submission cancelled.")
+    pin = ask("Enter your 4-digit PIN for verification: ").strip()
+    if refused(require_secret, username, 'pin', pin, "Incorrect PIN. Quest submission cancelled."):
         return
     
     # ensure due date has not passed
     quest = quests[qid]
-    due_date = datetime.datetime.strptime(quest['due_date'], "%Y-%m-%d").date()
-    if due_date < datetime.date.today():
-        print("The due date for this quest has already passed. You cannot submit it.")
+    if refused(check_submission_due, quest):
         return
     
     # check for required proofs in inventory
     req_proofs = quest['required_proofs']
     # print required proofs
-    print("Provide proof item: ", ", ".join(req_proofs))
+    say("Provide proof item: ", ", ".join(req_proofs))
     user_proof = []
     # get proof items from user
     while True:
-        proof = input("Add proof item (blank to stop): ").strip()
+        proof = ask("Add proof item (blank to stop): ").strip()
         if proof == "":
             break
         user_proof.append(proof)
@@ -397,60 +2127,23 @@ def submit_quest(username):
     if not validate_proofs(*user_proof, required=req_proofs):
         return
     
-    # check if user has enough stamina to submit quest (10 stamina)
-    if profile['stamina'] < 10:
-        print("You do not have enough stamina to submit this quest. Minimum 10 stamina required.")
+    result = execute({"action": "submit", "username": username, "quest_id": qid, "pin": pin, "proofs": user_proof})
+    if not result['ok']:
+        say(result['error'])
         return
-    
-    # submit quest
-    profile['accepted'].remove(qid)
-    # submit dictionary for history logging
-    profile['completed'].append(quest)
-    profile['stamina'] -= 10
-    profile['exp'] += quest['rewards']['exp']
-    # use overloaded str() in Rank class to check new rank
-    rank = str(Rank(profile['exp']))
-    # if rank changed, update rank
-    rankChange = False
-    if profile['rank'] != rank:
-        profile['rank'] = rank
-        rankChange = True
-    profile['fame'] += quest['rewards']['fame']
-    # use Inventory class for the loots
-    current_inventory = Inventory(profile['inventory'])
-    # add loot to user
-    profile['inventory'] = current_inventory + quest['rewards']['loot']
-
-    # for history tracking
-    log_history(username, action_type="Submit", quest_id=qid, exp=quest['rewards']['exp'], fame=quest['rewards']['fame'], loot=quest['rewards']['loot'])
-    # add quest to quests.json as unaccepted
-    quest['accepted'] = None
-    # update due date to tomorrow
-    quest['due_date'] = (datetime.date.today() + datetime.timedelta(days=1)).strftime("%Y-%m-%d")
-    # save changes to json files
-    save('adventurers.json', users)
-    save('quests.json', quests)
-    print(f"Submit OK. You gained EXP: {quest['rewards']['exp']}, Fame: {quest['rewards']['fame']}, Loot: {quest['rewards']['loot']}")
+    say(f"Submit OK. You gained EXP: {result['exp']}, Fame: {result['fame']}, Loot: {result['loot']}")
     # if rank changed, announce it
-    if rankChange:
-        print(f"Congratulations!!! You have been promoted to the rank {rank}")
-# training logic closure
-def training():
-    # define base experience and diminishing factor
-    base_exp = 10
-    diminishing_factor = 0.8
-    
-    def train(username, skill, minutes=30, stamina_cost=5):
-        nonlocal base_exp
-        exp = 0
+    if result['promoted']:
+        say(f"Congratulations!!! You have been promoted to the rank {result['rank']}")
+# training with diminishing returns
+# returns the gained exp
+def train(username, skill, minutes=30, stamina_cost=5):
+    # retrieve profile
+    profile = users[username]
+    with user_locks[username]:
         # calculate exp with diminishing returns
-        # for every 20 minutes
-        for _ in range(minutes // 30):
-            exp += base_exp
-            base_exp *= diminishing_factor
-
-        # retrieve profile
-        profile = users[username]
+        # for every 30 minutes
+        exp = training_sessions.train(username, minutes // 30)
         # increase skill experience
         profile['skills'][skill] += int(exp)
         # reduce stamina by fixed amount
@@ -458,32 +2151,78 @@ def training():
 
         # log training in history and update user information in json
         log_history(username, action_type="Train", skill=skill, exp=int(exp), time=f"{minutes}m")
-        save('adventurers.json', users)
-        
-        print(f"Trained {skill} for {minutes} minutes. Gained {int(exp)} EXP.")
-    return train
-        
+        commit(usernames=[username])
+    return int(exp)
+
+# check if skill is valid
+def trainable(profile, skill):
+    if skill not in profile['skills']:
+        raise GuildError("Invalid skill name. Please try again.")
+
+# training time in minutes
+def validate_minutes(minutes):
+    if not isinstance(minutes, int) or minutes <= 0:
+        raise GuildError("Invalid time input. Minutes must be a number greater than 0.")
+
+# check if user has enough stamina, returns the stamina cost
+def check_stamina(profile, minutes):
+    # calculate additional stamina cost (2 stamina for every 30 min)
+    # use the Train class to get the cost
+    trainer = Train()
+    stamina_cost = trainer - minutes
+    if profile['stamina'] < stamina_cost:
+        raise GuildError("Not enough stamina. Training requires at least 5 stamina.")
+    return stamina_cost
+
+# train a skill
+def do_train(username, skill, pin, minutes=30):
+    profile = users[username]
+    trainable(profile, skill)
+    validate_minutes(minutes)
+    stamina_cost = check_stamina(profile, minutes)
+    require_secret(username, 'pin', pin, "Incorrect PIN. Training cancelled.")
+
+    # apply training with or without defaults
+    if minutes == 30:
+        exp = train(username, skill)
+    else:
+        exp = train(username, skill, minutes=minutes, stamina_cost=stamina_cost)
+    return {"skill": skill, "minutes": minutes, "exp": exp}
+
+# rest to recover stamina
+def do_rest(username, minutes=30):
+    validate_minutes(minutes)
+    profile = users[username]
+    # using Train class to overload the '+' operator
+    resting = Train()
+    # using overloaded operator to get recovered stamina
+    stamina_gain = resting + minutes
+    with user_locks[username]:
+        # add stamina back
+        profile['stamina'] += stamina_gain
+        # log into history and update user information in json
+        log_history(username, action_type="Rest", stamina=int(stamina_gain), time=f"{minutes}m")
+        commit(usernames=[username])
+    return {"minutes": minutes, "stamina": int(stamina_gain)}
 
 # training skill
 def train_skill(username):
     # get user profile
     profile = users[username]
-    global active
 
     # get skill to train
-    skill = input("Skill to train [e.g., hunting, herbology, sword, alchemy, craft, rest] (0 to cancel): ").strip().lower()
+    skill = ask("Skill to train [e.g., hunting, herbology, sword, alchemy, craft, rest] (0 to cancel): ").strip().lower()
     # if user inputs '0', cancel
     if skill == '0':
-        print("Training cancelled.\n")
+        say("Training cancelled.\n")
         return
     
     # check if skill is valid
-    if skill not in profile['skills'] and skill != 'rest':
-        print("Invalid skill name. Please try again.")
+    if skill != 'rest' and refused(trainable, profile, skill):
         return
     
     # get training time in minutes
-    train_time = input("Minutes [default 30]:").strip()
+    train_time = ask("Minutes [default 30]:").strip()
     # process training time input
     # default to 30 if blank
     if train_time == '':
@@ -493,52 +2232,237 @@ def train_skill(username):
         train_time = int(train_time)
     # wrong input
     else:
-        print("Invalid time input. Minutes must be a number greater than 0.")
+        say("Invalid time input. Minutes must be a number greater than 0.")
         return
     
     # if skill is resting, use the Rest class's + operator
     if skill == 'rest':
-        # using Train class to overload the '+' operator
-        resting = Train()
-        # using overloaded operator to get recovered stamina
-        stamina_gain = resting + train_time
-        # add stamina back
-        profile['stamina'] += stamina_gain
-        # log into history and update user information in json
-        log_history(username, action_type="Rest", stamina=int(stamina_gain), time=f"{train_time}m")
-        save('adventurers.json', users)
-        print(f"Rested for {train_time} minutes. Stamina + {int(stamina_gain)}")
+        result = execute({"action": "rest", "username": username, "minutes": train_time})
+        say(f"Rested for {train_time} minutes. Stamina + {result['stamina']}")
         return
 
-
-    # calculate additional stamina cost (2 stamina for every 30 min)
-    # use the Train class to get the cost
-    trainer = Train()
-    stamina_cost = trainer - train_time
-
     # check if user has enough stamina
-    if profile['stamina'] < stamina_cost:
-        print("Not enough stamina. Training requires at least 5 stamina.")
+    if refused(check_stamina, profile, train_time):
         return
     
     # input pin for verification
-    pin = input("Enter your 4-digit PIN for verification: ").strip()
-    if profile['pin'] != hash(pin):
-        print("Incorrect PIN. Training cancelled.")
+    pin = ask("Enter your 4-digit PIN for verification: ").strip()
+    if refused(require_secret, username, 'pin', pin, "Incorrect PIN. Training cancelled."):
         return
     
-    # call closure to apply training
-    if username not in active:
-        # once per user session
-        active[username] = training()
-    current = active[username]
-
-    # use the closure function with or without defaults
-    if train_time == 30:
-        current(username, skill)
-    else:
-        current(username, skill, minutes=train_time, stamina_cost=stamina_cost)
-    return
+    result = execute({"action": "train", "username": username, "skill": skill, "pin": pin, "minutes": train_time})
+    if not result['ok']:
+        say(result['error'])
+        return
+    say(f"Trained {skill} for {train_time} minutes. Gained {result['exp']} EXP.")
+
+# leaderboards
+LEADERBOARD_SIZE = 10
+
+# best adventurers of a board, the adventurer's place and adventurers per rank tier
+def do_leaderboard(username, board='exp', count=LEADERBOARD_SIZE):
+    if board not in Leaderboards.BOARDS:
+        raise GuildError("Invalid leaderboard. Please try again.")
+    validate_number("count", count, minimum=0)
+    place, total = leaderboards.place(board, username)
+    return {"board": board, "top": [[name, score] for name, score in leaderboards.top(board, count)],
+            "place": place, "total": total, "tiers": leaderboards.tier_counts()}
+
+# how many of an item all adventurers hold
+def do_item_total(username, item):
+    if not isinstance(item, str):
+        raise GuildError("Invalid item name.")
+    return {"item": item, "total": item_totals.count(item)}
+
+# show leaderboard
+def leaderboard(username):
+    board = ask("Leaderboard (exp / fame) [default: exp]: ").strip().lower() or 'exp'
+    result = execute({"action": "leaderboard", "username": username, "board": board})
+    if not result['ok']:
+        say(result['error'])
+        return
+    say(f"\n=== Top {LEADERBOARD_SIZE} by {board} ===")
+    for number, (name, score) in enumerate(result['top'], 1):
+        say(f"{number}. {name}\t{score}")
+    say(f"Your place: {result['place']} of {result['total']}")
+    say("  ".join(f"{tier}: {count}" for tier, count in result['tiers'].items()))
+
+# Headless command API
+# a command is a dictionary, e.g. {"action": "accept", "username": "bob", "quest_id": "Q027", "pin": "1234"}
+# the result is {"ok": True, ...} with the action's results, or {"ok": False, "error": message}
+# the menus above run their actions through execute() as well
+
+# page numbers, sizes and counts of the query commands
+def validate_number(name, value, minimum=1):
+    if not isinstance(value, int) or isinstance(value, bool) or value < minimum:
+        raise GuildError(f"Invalid {name}: must be a whole number of at least {minimum}.")
+
+# the whole profile, with plain dictionaries
+def do_profile(username):
+    profile = users[username]
+    return {"profile": {key: dict(value) if isinstance(value, collections.abc.Mapping) else value
+                        for key, value in profile.items() if key not in ('pwd', 'pin')}}
+
+# quests the adventurer can accept right now, one page
+def do_quests(username, page=1, page_size=QUEST_PAGE_SIZE):
+    validate_number("page", page)
+    validate_number("page_size", page_size)
+    page_qids, total = quest_index.eligible(users[username], page, page_size)
+    return {"quests": {qid: quests[qid] for qid in page_qids}, "total": total}
+
+# latest history entries (before a timestamp)
+# cursor: the "cursor" of the previous page, for the entries older than it (None when there are none)
+def do_history(username, count=HISTORY_PAGE_SIZE, before=None, cursor=None):
+    validate_number("count", count)
+    # an ISO timestamp, like the dates of the entries
+    if before is not None and not isinstance(before, str):
+        raise GuildError("Invalid before: must be a timestamp like 2025-01-01T12:00:00.")
+    # [segment number, position] as returned by an earlier call
+    if cursor is not None:
+        if not isinstance(cursor, (list, tuple)) or len(cursor) != 2:
+            raise GuildError("Invalid cursor: must be the cursor of an earlier history page.")
+        validate_number("cursor", cursor[0])
+        validate_number("cursor", cursor[1], minimum=0)
+    entries, cursor = history_store.page(username, count, before, cursor)
+    return {"entries": entries, "cursor": list(cursor) if cursor is not None else None}
+
+# action -> function, with the parameters of a command
+COMMANDS = {
+    "register": do_register,
+    "login": do_login,
+    "accept": do_accept,
+    "submit": do_submit,
+    "train": do_train,
+    "rest": do_rest,
+    "profile": do_profile,
+    "quests": do_quests,
+    "history": do_history,
+    "leaderboard": do_leaderboard,
+    "item_total": do_item_total,
+}
+SIGNATURES = {action: inspect.signature(function) for action, function in COMMANDS.items()}
+
+# arguments that are names (dictionary keys), they must be strings
+NAME_ARGUMENTS = ('username', 'quest_id', 'skill', 'board', 'item')
+
+# names that are not strings, and proofs that are not a list of strings
+def check_arguments(command):
+    for name in NAME_ARGUMENTS:
+        if name in command and not isinstance(command[name], str):
+            raise GuildError(f"Invalid {name}: must be a string.")
+    if 'proofs' in command:
+        proofs = command['proofs']
+        if not isinstance(proofs, (list, tuple)) or not all(isinstance(proof, str) for proof in proofs):
+            raise GuildError("Invalid proofs: must be a list of strings.")
+
+# commands that need an existing adventurer
+def unknown_adventurer(action, command):
+    return action not in ('register', 'login') and command.get('username') not in users
+
+# run one command
+def execute(command):
+    command = dict(command)
+    action = command.pop('action', None)
+    if action not in COMMANDS:
+        return {"ok": False, "error": f"Unknown action: {action}"}
+    try:
+        SIGNATURES[action].bind(**command)
+    except TypeError as error:
+        return {"ok": False, "error": f"Invalid {action} command: {error}"}
+    try:
+        check_arguments(command)
+    except GuildError as error:
+        return {"ok": False, "error": str(error)}
+    if unknown_adventurer(action, command):
+        return {"ok": False, "error": f"Unknown adventurer: {command.get('username')}"}
+    try:
+        result = COMMANDS[action](**command)
+    except GuildError as error:
+        return {"ok": False, "error": str(error)}
+    # only applied commands are recorded, a replay cannot check the secrets of refused ones
+    if trace_recorder is not None and not replaying.get():
+        trace_recorder.record(action, command)
+    result['ok'] = True
+    return result
+
+# bulk apply: run commands in order, their changes are saved with one commit at the end
+# replay: the commands come from a trace (no secrets), credentials are not checked
+# outside of a session, verifications are remembered for the rest of the batch
+def execute_many(commands, replay=False):
+    batch = (set(), set())
+    batch_token = pending.set(batch)
+    replay_token = replaying.set(replay)
+    verified_token = verified.set({}) if verified.get() is None else None
+    try:
+        return [execute(command) for command in commands]
+    finally:
+        pending.reset(batch_token)
+        replaying.reset(replay_token)
+        if verified_token is not None:
+            verified.reset(verified_token)
+        commit(usernames=sorted(batch[0]), quest_ids=sorted(batch[1]))
+
+# Session class: a headless client, like one console session
+# verifications are remembered across its commands (see verify()) until logout()
+class Session:
+    def __init__(self):
+        self.verified = {}
+
+    # run fn(*args) with this session's verifications
+    def run(self, fn, *args, **kwargs):
+        token = verified.set(self.verified)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            verified.reset(token)
+
+    def execute(self, command):
+        return self.run(execute, command)
+
+    def execute_many(self, commands, replay=False):
+        return self.run(execute_many, commands, replay=replay)
+
+    # forget the verifications of a user
+    def logout(self, username):
+        self.run(forget, username)
+
+# TraceRecorder class: appends every executed command to a json lines file
+# passwords and PINs are not recorded
+class TraceRecorder:
+    SECRETS = ('password', 'pin')
+
+    def __init__(self, path):
+        self.file = open(path, 'a')
+        self.lock = threading.Lock()
+
+    def record(self, action, command):
+        entry = {"action": action}
+        entry.update((key, None if key in self.SECRETS else value) for key, value in command.items())
+        line = json.dumps(entry, separators=(',', ':'), default=plain) + '\n'
+        with self.lock:
+            self.file.write(line)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+# replay a recorded trace as fast as possible, batch_size commands per commit
+# returns the number of actions, how many were refused and actions/sec
+def replay(path, batch_size=1000):
+    actions = 0
+    failed = 0
+    start = time.perf_counter()
+    with open(path, 'r') as file:
+        while True:
+            commands = [json.loads(line) for line in itertools.islice(file, batch_size)]
+            if not commands:
+                break
+            results = execute_many(commands, replay=True)
+            actions += len(results)
+            failed += sum(1 for result in results if not result['ok'])
+    seconds = time.perf_counter() - start
+    return {"actions": actions, "failed": failed, "seconds": seconds,
+            "actions_per_sec": actions / seconds if seconds else 0.0}
 
 # main menu after login
 def main_menu(username):
@@ -546,11 +2470,13 @@ def main_menu(username):
     profile = users[username]
     # main menu loop
     while True:
-        print("\n=== Main ===")
+        # release quests that expired meanwhile (cheap when nothing is due)
+        expiry_scheduler.tick()
+        say("\n=== Main ===")
         # display user info
-        print(f"User: {username}\tID: {profile['id']}\tRank: {profile['rank']}\tStamina: {profile['stamina']}")
-        print("[1] History\t[2] Accept Quest\t[3] Submit Quest\t[4] Train Skill\t[9] Logout")
-        choice = input("Select: ").strip()
+        say(f"User: {username}\tID: {profile['id']}\tRank: {profile['rank']}\tStamina: {profile['stamina']}")
+        say("[1] History\t[2] Accept Quest\t[3] Submit Quest\t[4] Train Skill\t[5] Leaderboard\t[9] Logout")
+        choice = ask("Select: ").strip()
         # choice 1: view history
         if choice == '1':
             # display history
@@ -564,20 +2490,26 @@ def main_menu(username):
         # choice 4: train skill
         elif choice == '4':
             train_skill(username)
+        # choice 5: leaderboards
+        elif choice == '5':
+            leaderboard(username)
         # choice 9: logout
         elif choice == '9':
-            print("Logging out...\n")
+            forget(username)
+            say("Logging out...\n")
             break
         # invalid choice
         else:
-            print("Invalid selection. Please try again.")
+            say("Invalid selection. Please try again.")
 
 # main function
 def main():
+    # verifications are remembered per session
+    verified.set({})
     while True:
-        print("=== Adventurer's Guild ===")
-        print("[1] Register\t[2] Login\t[0] Exit")
-        choice = input("Select: ").strip()
+        say("=== Adventurer's Guild ===")
+        say("[1] Register\t[2] Login\t[0] Exit")
+        choice = ask("Select: ").strip()
         # choice 1: register
         if choice == '1':
             registration()
@@ -588,23 +2520,120 @@ def main():
                 main_menu(user)
         # choice 0: exit program
         elif choice == '0':
-            print("Bye!")
+            say("Bye!")
             break
         # invalid choice
         else:
-            print("Invalid selection. Please try again.\n")
+            say("Invalid selection. Please try again.\n")
+
+
+# Network server
+# every connection runs the same menus as the console (main()) in a worker thread
+# ask() / say() of that thread go through the connection
+
+# SessionIO class: bridges a blocking session thread to an asyncio stream
+# idle_timeout: seconds a client may leave a prompt unanswered (or stop reading), then the
+# session ends and its worker thread is free for the next connection; None = no limit
+class SessionIO:
+    def __init__(self, reader, writer, loop, idle_timeout=None):
+        self.reader = reader
+        self.writer = writer
+        self.loop = loop
+        self.idle_timeout = idle_timeout
+        # output is buffered until the next prompt
+        self.output = []
+
+    def say(self, text):
+        self.output.append(text)
+
+    # send buffered output (runs on the event loop)
+    async def send(self, text):
+        self.writer.write(text.encode())
+        try:
+            await asyncio.wait_for(self.writer.drain(), self.idle_timeout)
+        except asyncio.TimeoutError:
+            raise ConnectionAbortedError("client stopped reading")
+
+    # send output and the prompt, then wait for one line (runs on the event loop)
+    # an idle client reads as a closed connection
+    async def exchange(self, text):
+        await self.send(text)
+        try:
+            return await asyncio.wait_for(self.reader.readline(), self.idle_timeout)
+        except asyncio.TimeoutError:
+            self.writer.write(b"\nSession timed out.\n")
+            return b''
+
+    # called from the session thread, like input()
+    def ask(self, prompt):
+        self.output.append(prompt)
+        text = ''.join(self.output)
+        self.output = []
+        line = asyncio.run_coroutine_threadsafe(self.exchange(text), self.loop).result()
+        # connection closed
+        if not line:
+            raise EOFError
+        return line.decode().rstrip('\r\n')
+
+    # send what is left at the end of the session
+    def flush(self):
+        if self.output:
+            text = ''.join(self.output)
+            self.output = []
+            asyncio.run_coroutine_threadsafe(self.send(text), self.loop).result()
+
+# serve sessions until interrupted
+# max_sessions: sessions running at the same time, later connections wait
+# idle_timeout: seconds before an unanswered prompt ends its session (see SessionIO)
+async def serve(host='127.0.0.1', port=8765, max_sessions=256, idle_timeout=300):
+    loop = asyncio.get_running_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_sessions, thread_name_prefix='session')
+
+    async def handle(reader, writer):
+        io = SessionIO(reader, writer, loop, idle_timeout)
 
+        # one session: the console menus with this connection's I/O
+        def session():
+            session_io.set(io)
+            try:
+                main()
+                io.flush()
+            # client disconnected
+            except (EOFError, ConnectionError):
+                pass
 
-# load or initialize guild data from json file
-users = load('adventurers.json')
-quests = load('quests.json')
+        try:
+            # copy_context: session_io is only set for this session
+            await loop.run_in_executor(executor, contextvars.copy_context().run, session)
+        except Exception as error:
+            print(f"Session error: {error!r}", file=sys.stderr)
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
 
-# Global scope for active trainers (to reduce the constant calling of the closure function during training)
-active = {}
+    # expire quests even when nobody is in the main menu
+    async def expire():
+        while True:
+            await asyncio.sleep(60)
+            await loop.run_in_executor(None, expiry_scheduler.tick)
 
-# if quests data is empty, initialize with default quests
-if quests == {}:
-    quests = {
+    server = await asyncio.start_server(handle, host, port)
+    address = server.sockets[0].getsockname()
+    print(f"Serving on {address[0]}:{address[1]}", flush=True)
+    expiry = asyncio.create_task(expire())
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        expiry.cancel()
+        executor.shutdown(wait=False)
+
+# default quests for a new guild
+def default_quests():
+    return {
         "Q007": {
             "title": "Herb Gathering",
             "difficulty": "EASY",
@@ -652,9 +2681,140 @@ if quests == {}:
         }
     }
 
-    save('quests.json', quests)
+# open a storage backend and load the guild data from it
+# id_digits: digits of new adventurer IDs
+# history: HistoryStore (default: history/ directory, kept forever)
+def open_storage(backend, id_digits=5, history=None, training=None):
+    global storage, users, quests, id_allocator, quest_index, history_store, quest_snapshots, quest_lookup, expiry_scheduler
+    global training_sessions, leaderboards, item_totals
+    storage = backend
+    quest_lookup = None
+    users, quests = storage.load()
+    history_store = history or HistoryStore()
+    training_sessions = training or TrainingSessions()
+    quest_snapshots = QuestSnapshots()
+    # if quests data is empty, initialize with default quests
+    if quests == {}:
+        quests.update(default_quests())
+        storage.commit({}, quests)
+    id_allocator = IdAllocator(digits=id_digits)
+    # lazy backends load and upgrade each profile on first use
+    if isinstance(users, LazyUsers):
+        id_allocator.open(users.ids())
+    else:
+        # move history lists to the history store, replace quest copies by references
+        upgraded = [username for username in users if upgrade_profile(username, users[username])]
+        storage.rewritten(upgraded)
+        if upgraded:
+            commit(usernames=upgraded)
+        # compact in-memory model
+        for username in users:
+            users[username] = Adventurer(users[username])
+        id_allocator.open(users[username]['id'] for username in users)
+    quest_index = QuestIndex(quests)
+    # release the quests that expired since the last run
+    expiry_scheduler = ExpiryScheduler(quests)
+    expiry_scheduler.tick()
+    # ranked / counted on the first query
+    leaderboards = Leaderboards()
+    item_totals = ItemTotals()
+
+# storage backend, users, quests, ID allocator and quest index (set by open_storage)
+storage = None
+users = {}
+quests = {}
+id_allocator = None
+quest_index = None
+history_store = None
+quest_snapshots = None
+expiry_scheduler = None
+training_sessions = None
+leaderboards = None
+item_totals = None
+# TraceRecorder of the executed commands (set by --record)
+trace_recorder = None
+
+if __name__ == '__main__':
+    # command line options
+    arguments = argparse.ArgumentParser(description="Adventurer's Guild")
+    arguments.add_argument('--storage', choices=['json', 'journal', 'sqlite', 'sharded'], default=None,
+                           help="json: rewrite the json files on every action (default, not with --serve), "
+                                "journal: append changes to guild.journal (default with --serve), "
+                                "sqlite: indexed tables in guild.db, "
+                                "sharded: one file per profile in profiles/, loaded on first use")
+    arguments.add_argument('--journal-threshold', type=int, default=1 << 20,
+                           help="journal size (bytes) that triggers background compaction")
+    arguments.add_argument('--import-json', action='store_true',
+                           help="import adventurers.json and quests.json into guild.db and exit")
+    arguments.add_argument('--export-json', action='store_true',
+                           help="export guild.db to adventurers.json and quests.json and exit")
+    arguments.add_argument('--id-digits', type=int, default=5,
+                           help="digits of new adventurer IDs (more digits widen the ID space)")
+    arguments.add_argument('--history-retention-days', type=int, default=None,
+                           help="delete history older than this many days (default: keep forever)")
+    arguments.add_argument('--history-rollup-days', type=int, default=None,
+                           help="sum Train / Rest history older than this many days per day (default: never)")
+    arguments.add_argument('--serve', action='store_true', help="serve concurrent sessions over TCP")
+    arguments.add_argument('--host', default='127.0.0.1', help="server address")
+    arguments.add_argument('--port', type=int, default=8765, help="server port (0 = any free port)")
+    arguments.add_argument('--max-sessions', type=int, default=256, help="sessions served at the same time")
+    arguments.add_argument('--idle-timeout', type=float, default=300,
+                           help="seconds before an idle connection is closed (0 = never)")
+    arguments.add_argument('--training-sessions', type=int, default=10000,
+                           help="training states cached in memory (the rest are read from training.db)")
+    arguments.add_argument('--training-ttl', type=int, default=3600,
+                           help="seconds an idle training state stays cached")
+    arguments.add_argument('--record', default=None, help="append every executed command to this trace file")
+    arguments.add_argument('--replay', default=None, help="replay a recorded trace file and exit")
+    arguments.add_argument('--replay-batch', type=int, default=1000, help="replayed commands per commit")
+    args = arguments.parse_args()
+
+    # the json backend encodes every profile on every commit, while other sessions
+    # change their own profiles under their user locks only
+    if args.serve and args.storage == 'json':
+        arguments.error("--serve cannot use the json backend, choose journal, sqlite or sharded")
+    if args.storage is None:
+        args.storage = 'journal' if args.serve else 'json'
+
+    # json import / export for the sqlite database
+    if args.import_json or args.export_json:
+        database = SQLiteStorage()
+        if args.import_json:
+            database.import_json()
+        else:
+            database.export_json()
+        database.close()
+    else:
+        # load or initialize guild data
+        histories = HistoryStore(retention_days=args.history_retention_days, rollup_days=args.history_rollup_days)
+        trainings = TrainingSessions(max_sessions=args.training_sessions, ttl=args.training_ttl)
+        if args.storage == 'journal':
+            open_storage(Journal(threshold=args.journal_threshold), args.id_digits, histories, trainings)
+        elif args.storage == 'sqlite':
+            open_storage(SQLiteStorage(), args.id_digits, histories, trainings)
+        elif args.storage == 'sharded':
+            open_storage(ShardedStorage(), args.id_digits, histories, trainings)
+        else:
+            open_storage(JsonStorage(), args.id_digits, histories, trainings)
 
-main()
+        if args.record:
+            trace_recorder = TraceRecorder(args.record)
+        try:
+            if args.replay:
+                stats = replay(args.replay, args.replay_batch)
+                print(f"Replayed {stats['actions']} actions ({stats['failed']} refused) in {stats['seconds']:.2f}s, "
+                      f"{stats['actions_per_sec']:,.0f} actions/sec")
+            elif args.serve:
+                asyncio.run(serve(args.host, args.port, args.max_sessions, args.idle_timeout or None))
+            else:
+                main()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if trace_recorder is not None:
+                trace_recorder.close()
+            training_sessions.close()
+            storage.close()
 # attempt to show binding error
 # log_history("test_user", type="Broken", date="2025-01-01")
 # log_history("test_user", date="2025-01-01")
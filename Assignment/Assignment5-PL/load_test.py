@@ -0,0 +1,109 @@
+# Load test for the guild server (2021315385_guild.py --serve)
+# Starts the server on a fresh guild in a temporary directory, runs many
+# concurrent client sessions and checks that a contested quest is accepted once
+# usage: python load_test.py --sessions 500 --concurrency 100 --racers 50
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+GUILD = os.path.join(os.path.dirname(os.path.abspath(__file__)), '2021315385_guild.py')
+
+# quest every racer tries to accept (due today, herbology 5 = default skill)
+RACE_QUEST = 'Q007'
+PASSWORD = 'Password!'
+PIN = '1234'
+
+# Client scripts (menu selections, one line each)
+
+# register, login, rest 30 minutes, logout, exit
+def register_script(username):
+    return ['1', username, PASSWORD, PIN,
+            '2', username, PASSWORD,
+            '4', 'rest', '30',
+            '9', '0']
+
+# login, accept the contested quest, show history, logout, exit
+def race_script(username):
+    return ['2', username, PASSWORD,
+            '2', RACE_QUEST, PIN, 'NORMAL',
+            '1',
+            '9', '0']
+
+# Clients
+
+# send the whole script at once and read until the server closes the session
+async def run_session(host, port, lines):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(('\n'.join(lines) + '\n').encode())
+    await writer.drain()
+    output = await reader.read()
+    writer.close()
+    await writer.wait_closed()
+    return output.decode()
+
+# run one session per script, at most concurrency at the same time
+async def run_sessions(host, port, scripts, concurrency):
+    limit = asyncio.Semaphore(concurrency)
+
+    async def limited(lines):
+        async with limit:
+            return await run_session(host, port, lines)
+
+    return await asyncio.gather(*(limited(lines) for lines in scripts))
+
+# Server
+
+# start the server on any free port, returns the process and its port
+def start_server(directory, storage, max_sessions):
+    server = subprocess.Popen(
+        [sys.executable, GUILD, '--storage', storage, '--serve', '--port', '0',
+         '--max-sessions', str(max_sessions)],
+        cwd=directory, stdout=subprocess.PIPE, text=True)
+    # first line: "Serving on host:port"
+    line = server.stdout.readline()
+    if not line.startswith('Serving on'):
+        server.kill()
+        raise RuntimeError(f"Server did not start: {line!r}")
+    return server, int(line.rsplit(':', 1)[1])
+
+# Load test
+
+async def load_test(host, port, sessions, concurrency, racers):
+    # registration load
+    usernames = [f"user{i}" for i in range(sessions)]
+    start = time.perf_counter()
+    outputs = await run_sessions(host, port, [register_script(name) for name in usernames], concurrency)
+    seconds = time.perf_counter() - start
+    failed = sum(1 for output in outputs if 'Registration successful' not in output or 'Bye!' not in output)
+    print(f"{sessions} sessions in {seconds:.2f}s ({sessions / seconds:,.0f} sessions/sec), {failed} failed")
+
+    # acceptance race: every racer starts at the same time
+    outputs = await run_sessions(host, port, [race_script(name) for name in usernames[:racers]], racers)
+    winners = sum(1 for output in outputs if f"Accept\t{RACE_QUEST}" in output)
+    print(f"{racers} adventurers raced for {RACE_QUEST}: {winners} accepted it")
+    return failed == 0 and winners == 1
+
+if __name__ == '__main__':
+    arguments = argparse.ArgumentParser(description="Load test the guild server")
+    arguments.add_argument('--sessions', type=int, default=200, help="client sessions to run")
+    arguments.add_argument('--concurrency', type=int, default=50, help="sessions open at the same time")
+    arguments.add_argument('--racers', type=int, default=20, help="sessions accepting the same quest")
+    arguments.add_argument('--storage', choices=['journal', 'sqlite', 'sharded'], default='journal',
+                           help="storage backend of the server")
+    args = arguments.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        server, port = start_server(directory, args.storage, args.concurrency)
+        try:
+            ok = asyncio.run(load_test('127.0.0.1', port, args.sessions, args.concurrency,
+                                       min(args.racers, args.sessions)))
+        finally:
+            server.terminate()
+            server.wait()
+    # non-zero exit status when a session failed or the race had no single winner
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,82 @@
+# Memory benchmark of the adventurer model in 2021315385_guild.py
+# Builds synthetic profiles as plain dictionaries (the json representation) and
+# as Adventurer objects, and compares the memory they hold
+# usage: python model_benchmark.py --users 100000,1000000
+
+import argparse
+import gc
+import importlib.util
+import os
+import random
+import time
+import tracemalloc
+
+# the module name starts with digits, load it by path
+spec = importlib.util.spec_from_file_location(
+    'guild', os.path.join(os.path.dirname(os.path.abspath(__file__)), '2021315385_guild.py'))
+guild = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(guild)
+
+ITEMS = ['coin_pouch', 'boar_hide', 'herb_bundle', 'iron_ore', 'caravan_badge']
+
+# one synthetic profile as loaded from adventurers.json
+# names come from json parsing, so every profile has its own copies of the strings
+def generate_profile(rng, number):
+    return {
+        "id": 10000 + number,
+        "pwd": f"pbkdf2_sha256$200000${rng.getrandbits(128):032x}${rng.getrandbits(256):064x}",
+        "pin": f"pbkdf2_sha256$200000${rng.getrandbits(128):032x}${rng.getrandbits(256):064x}",
+        "rank": ''.join("BRONZE"),
+        "exp": rng.randint(0, 600),
+        "fame": rng.randint(0, 50),
+        "stamina": rng.randint(0, 100),
+        "skills": {''.join(skill): rng.randint(5, 60) for skill in guild.SKILLS},
+        "inventory": {''.join(item): rng.randint(1, 20) for item in rng.sample(ITEMS, 2)},
+        "accepted": [f"Q{rng.randint(0, 999):03d}"],
+        "completed": [{"quest_id": f"Q{rng.randint(0, 999):03d}", "version": "8ce32d0d95ff",
+                       "completed": "2026-10-18T19:05:28"} for _ in range(2)],
+    }
+
+# users: username -> profile, model: function converting a profile dictionary
+def build(count, model, seed=0):
+    rng = random.Random(seed)
+    users = {}
+    for number in range(count):
+        # ''.join() makes a fresh string, like json.load does
+        users[''.join(f"user{number}")] = model(generate_profile(rng, number))
+    return users
+
+# memory held by the users dictionary (bytes) and the seconds to build it
+def measure(count, model):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    users = build(count, model)
+    seconds = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del users
+    gc.collect()
+    return memory, seconds
+
+# check that the compact model reads like the dictionaries
+def check(count=1000):
+    plain = build(count, dict)
+    compact = build(count, guild.Adventurer)
+    for username, profile in plain.items():
+        assert dict(guild.plain(compact[username])) | {"skills": dict(compact[username]['skills'])} == profile
+
+if __name__ == '__main__':
+    arguments = argparse.ArgumentParser(description="Memory benchmark of the adventurer model")
+    arguments.add_argument('--users', default='100000,1000000', help="comma separated profile counts")
+    args = arguments.parse_args()
+
+    check()
+    for count in (int(value) for value in args.users.split(',')):
+        print(f"{count:,} users")
+        results = {}
+        for name, model in (("dict", dict), ("Adventurer", guild.Adventurer)):
+            memory, seconds = measure(count, model)
+            results[name] = memory
+            print(f"  {name:<11} {memory / 2 ** 20:9,.1f} MiB  {memory / count:7,.0f} bytes/user  built in {seconds:.1f}s")
+        print(f"  saved {1 - results['Adventurer'] / results['dict']:.0%}")
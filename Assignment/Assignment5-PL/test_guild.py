@@ -0,0 +1,219 @@
+# Regression tests for 2021315385_guild.py
+# every test works in its own temporary directory, failures raise AssertionError
+# explicitly, so the tests also run under python -O
+# usage: python test_guild.py   (or python -m pytest test_guild.py)
+
+import asyncio
+import contextlib
+import datetime
+import importlib.util
+import json
+import os
+import socket
+import tempfile
+
+# the module name starts with digits, load it by path
+spec = importlib.util.spec_from_file_location(
+    'guild', os.path.join(os.path.dirname(os.path.abspath(__file__)), '2021315385_guild.py'))
+guild = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(guild)
+
+# Helpers
+
+# fail with a message unless actual == expected
+def expect(actual, expected, what):
+    if actual != expected:
+        raise AssertionError(f"{what}: got {actual!r}, expected {expected!r}")
+
+# history entry of a training session, days ago
+def train_entry(days, skill='sword'):
+    date = (datetime.datetime.now() - datetime.timedelta(days=days)).isoformat()
+    return {"type": "Train", "date": date, "skill": skill, "exp": 3, "time": "30m"}
+
+# open a fresh guild in a temporary working directory
+# backend: storage class, opened again for every reopen() of the test
+@contextlib.contextmanager
+def fresh_guild(backend):
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            guild.open_storage(backend())
+            yield lambda: reopen(backend)
+        finally:
+            close_guild()
+            os.chdir(cwd)
+
+def close_guild():
+    guild.storage.close()
+    guild.training_sessions.close()
+
+def reopen(backend):
+    close_guild()
+    guild.open_storage(backend())
+
+# History store
+
+# rolled-up segments are listed again after a restart
+def test_history_rollup_reopen():
+    with tempfile.TemporaryDirectory() as directory:
+        root = os.path.join(directory, 'history')
+        store = guild.HistoryStore(root, segment_entries=2, rollup_days=1)
+        store.append('bob', *[train_entry(days) for days in (10, 9, 8, 7, 6, 0)])
+        entries, _ = store.page('bob', 100)
+        expect(len(entries), 6, "entries before the restart")
+        expect(sum(1 for _, _, name in store.segments['bob'] if name.endswith('.rollup.jsonl')), 2,
+               "rolled-up segments")
+        reopened = guild.HistoryStore(root, segment_entries=2, rollup_days=1)
+        expect(reopened.page('bob', 100), (entries, None), "entries after the restart")
+        # retention deletes them like any other segment
+        expired = guild.HistoryStore(root, segment_entries=2, retention_days=3)
+        expect(expired.page('bob', 100), (entries[:2], None), "entries after retention")
+        expect(len(os.listdir(expired.directory('bob'))), 1, "segment files after retention")
+
+# pages follow each other without skipping entries that share a timestamp
+def test_history_cursor():
+    with tempfile.TemporaryDirectory() as directory:
+        store = guild.HistoryStore(os.path.join(directory, 'history'), segment_entries=7)
+        date = datetime.datetime.now().isoformat()
+        store.append('bob', *[{"type": "Rest", "date": date, "stamina": number, "time": "30m"} for number in range(45)])
+        seen = []
+        entries, cursor = store.page('bob', 20)
+        while True:
+            seen.extend(entry['stamina'] for entry in entries)
+            if cursor is None:
+                break
+            entries, cursor = store.page('bob', 20, cursor=cursor)
+        expect(seen, list(reversed(range(45))), "paged entries")
+
+# Registration
+
+# usernames with a tab or newline cannot forge lines of the sharded index
+def test_username_control_characters():
+    with fresh_guild(guild.ShardedStorage) as reopen:
+        result = guild.execute({"action": "register", "username": "evil\n12345\tbob",
+                                "password": "Password!", "pin": "1234"})
+        expect(result['ok'], False, "registration of a name with a newline")
+        guild.execute_many([{"action": "register", "username": "bob", "password": None, "pin": None}], replay=True)
+        reopen()
+        expect(sorted(guild.users), ['bob'], "adventurers after reopening")
+
+# Journal
+
+# a veteran's actions are journaled as deltas, and the journal replays to the same state
+def test_journal_deltas():
+    with fresh_guild(guild.Journal) as reopen:
+        session = guild.Session()
+        session.execute({"action": "register", "username": "bob", "password": "Password!", "pin": "1234"})
+        for _ in range(30):
+            for command in [{"action": "accept", "quest_id": "Q007"},
+                            {"action": "submit", "quest_id": "Q007", "proofs": ["herb_bundle"]},
+                            {"action": "rest", "minutes": 60}]:
+                result = session.execute(dict(command, username="bob", pin="1234") if command['action'] != 'rest'
+                                         else dict(command, username="bob"))
+                expect(result['ok'], True, f"{command['action']} result")
+        profile = json.loads(json.dumps(guild.users['bob'], default=guild.plain))
+        expect(len(profile['completed']), 30, "completed quests")
+        with open(guild.storage.path) as file:
+            records = [json.loads(line) for line in file]
+        # the last submit holds the new completed entry only
+        submit = [record for record in records if 'completed+' in record.get('deltas', {}).get('bob', {})][-1]
+        expect(submit['deltas']['bob']['completed+'][0], 29, "position of the new entry")
+        expect(len(submit['deltas']['bob']['completed+'][1]), 1, "new entries")
+        reopen()
+        expect(json.loads(json.dumps(guild.users['bob'], default=guild.plain)), profile, "profile after replay")
+        # replaying the journal again changes nothing
+        users, quests = guild.load('adventurers.json'), guild.load('quests.json')
+        guild.Journal.apply(guild.storage.path, users, quests)
+        guild.Journal.apply(guild.storage.path, users, quests)
+        expect(users['bob'], profile, "profile after replaying twice")
+
+# Quest expiry
+
+# an expired quest is released in a copy of the profile taken under the user lock,
+# the live profile is never handed to the storage backend
+def test_expiry_commits_copies():
+    with fresh_guild(guild.SQLiteStorage) as reopen:
+        session = guild.Session()
+        session.execute({"action": "register", "username": "bob", "password": "Password!", "pin": "1234"})
+        result = session.execute({"action": "accept", "username": "bob", "pin": "1234", "quest_id": "Q007"})
+        expect(result['ok'], True, "accept result")
+        committed = []
+        commit = guild.storage.commit
+        guild.storage.commit = lambda changed_users, changed_quests: (
+            committed.extend(changed_users.values()), commit(changed_users, changed_quests))
+        try:
+            due_date = datetime.date.fromisoformat(guild.quests['Q007']['due_date'])
+            expect(guild.expiry_scheduler.tick(due_date + datetime.timedelta(days=1)) >= 1, True, "expired quests")
+        finally:
+            guild.storage.commit = commit
+        expect(len(committed), 1, "committed profiles")
+        expect(committed[0] is guild.users['bob'], False, "committed the live profile")
+        expect(committed[0]['accepted'], [], "accepted quests of the copy")
+        reopen()
+        expect(guild.users['bob']['accepted'], [], "accepted quests after reopening")
+
+# Verification cache
+
+# a batch or a headless session hashes a PIN once, not once per command
+def test_verified_once():
+    with fresh_guild(guild.JsonStorage):
+        guild.execute({"action": "register", "username": "bob", "password": "Password!", "pin": "1234"})
+        commands = [{"action": "train", "username": "bob", "skill": "sword", "pin": "1234", "minutes": 1},
+                    {"action": "rest", "username": "bob", "minutes": 60}] * 5
+        checks = []
+        check_secret = guild.check_secret
+        guild.check_secret = lambda secret, stored: checks.append(secret) or check_secret(secret, stored)
+        try:
+            results = guild.execute_many(commands)
+            expect([result['ok'] for result in results], [True] * len(commands), "batch results")
+            expect(len(checks), 1, "hashes in a batch")
+            session = guild.Session()
+            for command in commands:
+                session.execute(command)
+            expect(session.execute(dict(commands[0], pin='0000'))['ok'], False, "wrong PIN in a session")
+            expect(len(checks), 3, "hashes in a session")
+        finally:
+            guild.check_secret = check_secret
+
+# Network server
+
+# an idle connection gives its worker thread up to the next client
+def test_idle_timeout():
+    async def sessions(port):
+        server = asyncio.create_task(guild.serve('127.0.0.1', port, max_sessions=1, idle_timeout=0.5))
+        try:
+            for _ in range(100):
+                try:
+                    idle = await asyncio.open_connection('127.0.0.1', port)
+                    break
+                except ConnectionError:
+                    await asyncio.sleep(0.05)
+            await idle[0].readuntil(b': ')
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            # served once the idle session timed out
+            await asyncio.wait_for(reader.readuntil(b': '), 5)
+            expect(b"timed out" in await asyncio.wait_for(idle[0].read(), 5), True, "idle connection closed")
+            # end of input ends the session, the server closes the connection
+            writer.write_eof()
+            await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+        finally:
+            server.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await server
+
+    with fresh_guild(guild.SQLiteStorage), socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+        with contextlib.redirect_stdout(None):
+            asyncio.run(sessions(port))
+
+# run every test
+if __name__ == '__main__':
+    tests = [(name, fn) for name, fn in globals().items() if name.startswith('test_') and callable(fn)]
+    for name, fn in tests:
+        fn()
+        print(f"{name}: ok")
+    print(f"{len(tests)} tests passed")